@@ -1,32 +1,56 @@
 from .py.utils.config import load_nodes_config
-from .py.nodes.node_factory import NodeFactory
-from .py.nodes.merge_strings import MergeStrings
-from .py.nodes.composer import Composer
-from .py.nodes.cleanup_prompt import CleanupPrompt
+from .py.utils.manifest import config_hash, load_manifest, write_manifest
+from .py.nodes.lazy_node import create_lazy_node, import_node_class
 
 NODE_CLASS_MAPPINGS = {}
 NODE_DISPLAY_NAME_MAPPINGS = {}
 WEB_DIRECTORY = "./web"
 
+# Additional nodes: id, display name, module and class in py.nodes
+EXTRA_NODES = [
+    ("MergeStrings", "🪡 Merge Strings", "merge_strings", "MergeStrings"),
+    ("Composer", "🖋️ Composer", "composer", "Composer"),
+    ("CleanupPrompt", "🧹 CleanUp Prompt", "cleanup_prompt", "CleanupPrompt"),
+    ("Pipeline", "🏭 Pipeline", "pipeline", "Pipeline"),
+]
+
 
 def register_node(node_id, node_name, node_class):
     NODE_CLASS_MAPPINGS[node_id] = node_class
     NODE_DISPLAY_NAME_MAPPINGS[node_id] = node_name
 
 
-# Create each node according to the config folder
-config = load_nodes_config()
+def register_nodes(digest):
+    "Create each node according to the config folder, save the manifest"
+    nodes = []
+    config = load_nodes_config()
+
+    for key, value in config.items():
+        node_id = key
+        node_name = value.get("name", key)
+        nodes.append((node_id, node_name, "node_factory", None))
+
+    nodes.extend(EXTRA_NODES)
+
+    registered = []
+    for node_id, node_name, module, class_name in nodes:
+        node_class = import_node_class(node_id, node_name, module, class_name)
+        register_node(node_id, node_name, node_class)
+        registered.append((node_id, node_name, module, class_name, node_class))
+
+    write_manifest(registered, digest=digest)
+
 
-for key, value in config.items():
-    node_id = key
-    node_name = value.get("name", key)
-    ClassNode = NodeFactory.create_node(node_id, node_name)
-    register_node(node_id, node_name, ClassNode)
+# Register the nodes from the manifest while the config is unchanged:
+# numpy and the node classes are imported when a node first executes
+digest = config_hash()
+manifest = load_manifest(digest=digest)
 
-# Add additional nodes
-register_node("MergeStrings", "🪡 Merge Strings", MergeStrings)
-register_node("Composer", "🖋️ Composer", Composer)
-register_node("CleanupPrompt", "🧹 CleanUp Prompt", CleanupPrompt)
+if manifest is None:
+    register_nodes(digest)
+else:
+    for entry in manifest:
+        register_node(entry["id"], entry["name"], create_lazy_node(entry))
 
 __all__ = [
     "NODE_CLASS_MAPPINGS",
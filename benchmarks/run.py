@@ -0,0 +1,297 @@
+"""
+Benchmarks of the prompt-building hot paths
+
+Run every case against the default config and synthetic configs:
+    python benchmarks/run.py
+    python benchmarks/run.py --scale 100:1000:3:1000 --output after.json
+    python benchmarks/run.py --compare before.json
+
+A scale is NODES:TAGS:DEPTH:VARIABLES (nodes, tags per group,
+nesting depth of the groups, global variables).
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..")))
+
+from py.utils import config  # noqa: E402
+from py.utils.config import ConfigStore, chose_config  # noqa: E402
+from py.nodes.node_factory import NodeFactory  # noqa: E402
+from py.nodes.node_factory._tags import select_tags  # noqa: E402
+from py.nodes.node_factory._compiler import compile_config  # noqa: E402
+from py.nodes.node_factory._inputs import apply_input_values  # noqa: E402
+from py.nodes.node_factory._variables import (  # noqa: E402
+    apply_variables,
+    load_variables
+)
+from py.nodes.composer import Composer  # noqa: E402
+from py.nodes.cleanup_prompt import CleanupPrompt  # noqa: E402
+from synthetic import write_synthetic_config  # noqa: E402
+
+DEFAULT_SCALES = ["10:10:1:10", "100:100:2:100"]
+
+
+def use_config(resolve_path):
+    "Point the config loaders at another config folder"
+    config.config_store = ConfigStore(resolve_path)
+    return config.config_store
+
+
+def folder(path):
+    "resolve_path function of a config folder"
+    return lambda extra_path="": os.path.join(path, extra_path)
+
+
+def first_group(data):
+    "Largest tag group of a node, to benchmark select_tags() on"
+    groups = [value for value in data["tags"].values()
+              if isinstance(value, (dict, list))]
+    return max(groups, key=lambda group: len(json.dumps(group)))
+
+
+def cases(nodes):
+    "Yield (name, function of a seed) for each benchmarked operation"
+    node_id = max(nodes, key=lambda key: len(json.dumps(nodes[key])))
+    node = NodeFactory.create_node(node_id)()
+    group = first_group(node.data)
+    rng = np.random.default_rng(0)
+    tags = {
+        key: select_tags(rng, value)
+        for key, value in apply_input_values(node.data["tags"], {}).items()
+    }
+    variables = load_variables(rng, node.data)
+
+    placeholders = " ".join(f"{{{key}}}" for key in list(variables)[:20])
+    composer = Composer()
+    composer_prompt = f"{placeholders}, {{{node_id}}}"
+
+    cleanup = CleanupPrompt()
+    cleanup_prompt = node.build_prompt(seed=0)[0] * 4
+
+    def run_select_tags(seed):
+        select_tags(np.random.default_rng(seed), group)
+
+    def run_compiled_select(seed):
+        compile_config(node.data).select(np.random.default_rng(seed), group)
+
+    def run_apply_variables(seed):
+        apply_variables(np.random.default_rng(seed), tags, variables)
+
+    def run_apply_input_values(seed):
+        apply_input_values(node.data["tags"], {})
+
+    def run_build_prompt(seed):
+        node.build_prompt(seed=seed)
+
+    def run_composer_lazy(seed):
+        composer.build_prompt(prompt=composer_prompt, seed=seed, lazy=True)
+
+    def run_composer_eager(seed):
+        composer.build_prompt(prompt=composer_prompt, seed=seed, lazy=False)
+
+    def run_cleanup(seed):
+        cleanup.cleanup_prompt(
+            cleanup_prompt, True, "random", "*hat*, *_1, *", seed)
+
+    def run_config_cold(seed):
+        ConfigStore(config.config_store.resolve_path).nodes()
+
+    def run_config_warm(seed):
+        config.load_nodes_config()
+
+    yield "select_tags", run_select_tags
+    yield "compiled select", run_compiled_select
+    yield "apply_variables", run_apply_variables
+    yield "apply_input_values", run_apply_input_values
+    yield "NodeFactory.build_prompt", run_build_prompt
+    yield "Composer.build_prompt[lazy]", run_composer_lazy
+    yield "Composer.build_prompt[eager]", run_composer_eager
+    yield "CleanupPrompt.cleanup_prompt", run_cleanup
+    yield "load_nodes_config[cold]", run_config_cold
+    yield "load_nodes_config[warm]", run_config_warm
+
+
+def measure(function, repeat, warmup, memory_repeat):
+    "Time each call of function, then measure its peak memory"
+    for seed in range(warmup):
+        function(seed)
+
+    timings = []
+    start = time.perf_counter_ns()
+    for seed in range(repeat):
+        call_start = time.perf_counter_ns()
+        function(seed)
+        timings.append(time.perf_counter_ns() - call_start)
+    total = time.perf_counter_ns() - start
+
+    tracemalloc.start()
+    for seed in range(memory_repeat):
+        function(seed)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    p50, p90, p99 = np.percentile(timings, [50, 90, 99]) / 1000
+    return {
+        "calls": repeat,
+        "ops_per_sec": repeat / (total / 1e9),
+        "p50_us": p50,
+        "p90_us": p90,
+        "p99_us": p99,
+        "peak_kib": peak / 1024,
+    }
+
+
+def benchmark(label, args):
+    "Run every case with the config currently loaded"
+    results = {}
+    nodes = config.load_nodes_config()
+    for name, function in cases(nodes):
+        key = f"{label}/{name}"
+        repeat = args.repeat
+        if "eager" in name or "cold" in name:
+            repeat = max(1, repeat // 10)
+        results[key] = measure(
+            function, repeat, args.warmup, max(1, repeat // 10))
+        print(format_result(key, results[key]), flush=True)
+    return results
+
+
+def format_result(key, result):
+    return (
+        f"{key:<55} {result['ops_per_sec']:>10.0f} op/s"
+        f" p50 {result['p50_us']:>9.1f}us"
+        f" p90 {result['p90_us']:>9.1f}us"
+        f" p99 {result['p99_us']:>9.1f}us"
+        f" peak {result['peak_kib']:>8.1f}KiB"
+    )
+
+
+def metadata():
+    "Describe the environment the results were measured in"
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(__file__)
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "commit": commit,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the p50 latency change of each case against a baseline
+    Return the cases slower than the threshold
+    """
+    regressions = []
+    print(f"\nCompared to {baseline['meta'].get('commit')}:")
+    for key, result in results.items():
+        before = baseline["results"].get(key)
+        if before is None:
+            continue
+        change = result["p50_us"] / before["p50_us"] - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(key)
+            flag = "  REGRESSION"
+        print(f"{key:<55} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def parse_scale(scale):
+    nodes, tags, depth, variables = (int(x) for x in scale.split(":"))
+    return {"nodes": nodes, "tags": tags, "depth": depth,
+            "variables": variables}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the prompt-building hot paths."
+    )
+
+    parser.add_argument(
+        "--scale",
+        action="append",
+        help="Synthetic config NODES:TAGS:DEPTH:VARIABLES (repeatable)"
+    )
+
+    parser.add_argument(
+        "--no-default",
+        action="store_true",
+        help="Skip the benchmarks on the current config"
+    )
+
+    parser.add_argument(
+        "-r", "--repeat",
+        type=int,
+        default=1000,
+        help="Timed calls per case"
+    )
+
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=20,
+        help="Untimed calls per case"
+    )
+
+    parser.add_argument(
+        "-o", "--output",
+        help="Save the results to a JSON file"
+    )
+
+    parser.add_argument(
+        "--compare",
+        help="JSON results to compare with"
+    )
+
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="p50 slowdown reported as a regression (default: 0.1)"
+    )
+
+    args = parser.parse_args()
+
+    results = {}
+    if not args.no_default:
+        use_config(chose_config)
+        results.update(benchmark("config", args))
+
+    for scale in args.scale or DEFAULT_SCALES:
+        with tempfile.TemporaryDirectory() as path:
+            write_synthetic_config(path, **parse_scale(scale))
+            use_config(folder(path))
+            results.update(benchmark(f"synthetic {scale}", args))
+
+    output = {"meta": metadata(), "results": results}
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(output, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
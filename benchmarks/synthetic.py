@@ -0,0 +1,70 @@
+import os
+import json
+import random
+
+
+def synthetic_node(index, tags, depth, variables, rng):
+    "Config of a synthetic node, with nested groups down to depth"
+
+    def group(level, name):
+        if level >= depth:
+            data = {"tags": [f"{name}_tag_{i}" for i in range(tags)]}
+            match rng.randrange(4):
+                case 0:
+                    data["probability"] = 0.5
+                case 1:
+                    data["distribution"] = [rng.random() * 2
+                                            for _ in range(tags // 2)]
+                case 2:
+                    data["number"] = [1, min(3, tags)]
+            if variables and rng.random() < 0.3:
+                data["tags"][0] = f"{{var_{rng.randrange(variables)}}} hat"
+            return data
+
+        return {
+            "number": 2,
+            "tags": {
+                f"{name}_{i}": group(level + 1, f"{name}_{i}")
+                for i in range(3)
+            }
+        }
+
+    node_tags = {}
+    for i in range(8):
+        node_tags[f"group_{i}"] = group(1, f"node_{index}_group_{i}")
+
+    return {
+        "name": f"Synthetic {index}",
+        "variables": {"local": f"{{var_0}} {index}"} if variables else {},
+        "tags": node_tags,
+    }
+
+
+def write_synthetic_config(path, nodes=10, tags=10, depth=1, variables=10,
+                           seed=0):
+    """
+    Write a synthetic config folder: nodes/*.json and variables.json
+    Scaled by node count, tags per group, nesting depth and variables
+    """
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(path, "nodes"), exist_ok=True)
+
+    for index in range(nodes):
+        node = synthetic_node(index, tags, depth, variables, rng)
+        with open(os.path.join(path, "nodes", f"node_{index}.json"),
+                  "w") as file:
+            json.dump(node, file)
+
+    global_variables = {}
+    for index in range(variables):
+        values = [f"value_{index}_{i}" for i in range(5)]
+        global_variables[f"var_{index}"] = \
+            {"fixed": False, "tags": values} if index % 2 else values
+
+    with open(os.path.join(path, "variables.json"), "w") as file:
+        json.dump(global_variables, file)
+
+    with open(os.path.join(path, "rules.json"), "w") as file:
+        json.dump([], file)
+
+    return path
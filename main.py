@@ -1,39 +1,156 @@
+import io
+import sys
+import csv
+import json
 import argparse
+from collections import deque
+from multiprocessing import Pool
+
 from py.nodes.node_factory import NodeFactory
+from py.nodes.node_factory._rules import rules_scope
 from py.utils.config import load_nodes_config
 
 config = load_nodes_config()
 
+FORMATS = ("jsonl", "csv", "txt")
+
+# Seeds generated by a worker at once in bulk mode
+CHUNK_SIZE = 2000
+
 
 def main(seed, with_inputs):
 
     print(f"SEED: {seed}")
     print("---")
 
-    # Create prompt for each node
-    for key, value in config.items():
-        ClassNode = NodeFactory.create_node(key)
-        node = ClassNode()
+    # Create prompt for each node, sharing the rules they trigger
+    with rules_scope():
+        for key, value in config.items():
+            ClassNode = NodeFactory.create_node(key)
+            node = ClassNode()
         
-        node_name = value.get("name", key)
-        inputs = node.INPUT_TYPES()["required"]
-        if "seed" in inputs:
-            del inputs["seed"]
-        prompt = node.build_prompt(seed=seed)
-
-        print(f"{node_name:<20} {prompt[0]}")
-
-        # Optionally display inputs
-        if with_inputs:
-            for sub_key, sub_value in inputs.items():
-                if isinstance(sub_value[0], list):
-                    sub_value = sub_value[0]
-                elif isinstance(sub_value[0], str):
-                    sub_value = sub_value[1]["default"]
-                    if sub_value is True:
-                        sub_value = "Boolean"
-                print(f"> {sub_key:<20} {sub_value}")
-            print("---")
+            node_name = value.get("name", key)
+            inputs = node.INPUT_TYPES()["required"]
+            if "seed" in inputs:
+                del inputs["seed"]
+            prompt = node.build_prompt(seed=seed)
+
+            print(f"{node_name:<20} {prompt[0]}")
+
+            # Optionally display inputs
+            if with_inputs:
+                for sub_key, sub_value in inputs.items():
+                    if isinstance(sub_value[0], list):
+                        sub_value = sub_value[0]
+                    elif isinstance(sub_value[0], str):
+                        sub_value = sub_value[1]["default"]
+                        if sub_value is True:
+                            sub_value = "Boolean"
+                    print(f"> {sub_key:<20} {sub_value}")
+                print("---")
+
+
+_nodes = {}
+
+
+def generate(node_ids, seeds):
+    """
+    Yield the prompts of the nodes for each seed
+    Nodes are only created once, and share the rules they trigger
+    """
+    nodes = []
+    for node_id in node_ids:
+        if node_id not in _nodes:
+            _nodes[node_id] = NodeFactory.create_node(node_id)()
+        nodes.append(_nodes[node_id])
+
+    for seed in seeds:
+        with rules_scope():
+            yield seed, [node.build_prompt(seed=seed)[0] for node in nodes]
+
+
+def report(node_ids):
+    "Print the probability of each tag of the nodes to be picked"
+    for node_id in node_ids:
+        node = NodeFactory.create_node(node_id)()
+        print(f"{config[node_id].get('name', node_id)}")
+        print("---")
+
+        for row in node.tag_report():
+            probability = f"{row['probability']:.4f}"
+            if not row["exact"]:
+                probability += f" [{row['low']:.4f}, {row['high']:.4f}]"
+            path = row["path"] if row["path"] is not None else "?"
+            print(f"{path:<30} {row['tag']:<30} {probability}")
+        print("---")
+
+
+def format_prompts(rows, node_ids, output_format):
+    "Format (seed, prompts) rows as text"
+    buffer = io.StringIO()
+
+    match output_format:
+        case "jsonl":
+            for seed, prompts in rows:
+                line = {"seed": seed, **dict(zip(node_ids, prompts))}
+                buffer.write(json.dumps(line, ensure_ascii=False) + "\n")
+        case "csv":
+            writer = csv.writer(buffer, lineterminator="\n")
+            writer.writerows([seed, *prompts] for seed, prompts in rows)
+        case "txt":
+            for seed, prompts in rows:
+                buffer.write(", ".join(p for p in prompts if p) + "\n")
+
+    return buffer.getvalue()
+
+
+def export_chunk(task):
+    "Generate and format the prompts of a range of seeds"
+    node_ids, seeds, output_format = task
+    return format_prompts(
+        generate(node_ids, seeds), node_ids, output_format)
+
+
+def export(node_ids, first_seed, count, output, output_format, workers):
+    """
+    Stream the prompts of a range of seeds to a file
+    Seeds are split in chunks, generated by a pool of workers and
+    written in seed order, keeping a bounded number of chunks in memory
+    """
+    last_seed = first_seed + count
+    tasks = (
+        (node_ids, range(seed, min(seed + CHUNK_SIZE, last_seed)),
+         output_format)
+        for seed in range(first_seed, last_seed, CHUNK_SIZE)
+    )
+
+    if output == "-":
+        file = sys.stdout
+    else:
+        file = open(output, "w", encoding="utf-8", buffering=1 << 20)
+
+    try:
+        if output_format == "csv":
+            csv.writer(file, lineterminator="\n").writerow(
+                ["seed", *node_ids])
+
+        if workers <= 1:
+            for task in tasks:
+                file.write(export_chunk(task))
+            return
+
+        with Pool(workers) as pool:
+            pending = deque()
+            for task in tasks:
+                pending.append(pool.apply_async(export_chunk, (task,)))
+                if len(pending) >= workers * 2:
+                    file.write(pending.popleft().get())
+            while pending:
+                file.write(pending.popleft().get())
+
+    finally:
+        if file is not sys.stdout:
+            file.close()
 
 
 if __name__ == "__main__":
@@ -55,5 +172,65 @@ if __name__ == "__main__":
         help="Display inputs for each node"
     )
 
+    parser.add_argument(
+        "-r", "--report",
+        action="store_true",
+        help="Display the probability of each tag to be picked"
+    )
+
+    parser.add_argument(
+        "-c", "--count",
+        type=int,
+        help="Bulk mode: export prompts for this many seeds, from --seed"
+    )
+
+    parser.add_argument(
+        "-n", "--nodes",
+        help="Bulk and report modes: comma separated node ids "
+             "(default: all nodes)"
+    )
+
+    parser.add_argument(
+        "-o", "--output",
+        default="-",
+        help="Bulk mode: output file (default: stdout)"
+    )
+
+    parser.add_argument(
+        "-f", "--format",
+        choices=FORMATS,
+        default="jsonl",
+        help="Bulk mode: output format"
+    )
+
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        default=1,
+        help="Bulk mode: number of worker processes"
+    )
+
     args = parser.parse_args()
-    main(seed=args.seed, with_inputs=args.inputs)
+
+    # Comma separated ids, spaces allowed, every node by default
+    node_ids = [
+        node_id.strip() for node_id in (args.nodes or "").split(",")
+        if node_id.strip()
+    ] or list(config)
+    unknown = [node_id for node_id in node_ids if node_id not in config]
+    if unknown:
+        parser.error(f"unknown nodes: {', '.join(unknown)}")
+
+    if args.report:
+        report(node_ids)
+    elif args.count is None:
+        main(seed=args.seed, with_inputs=args.inputs)
+    else:
+        export(
+            node_ids=node_ids,
+            first_seed=args.seed,
+            count=args.count,
+            output=args.output,
+            output_format=args.format,
+            workers=args.workers
+        )
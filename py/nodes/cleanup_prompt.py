@@ -1,14 +1,32 @@
-import numpy as np
+import os
+import re
 import fnmatch
+import threading
+from functools import lru_cache
+from operator import attrgetter
+
+import numpy as np
+
 from .node_factory._tags import stringify_tags
+from .node_factory._tag_list import Tag, TagList, TAG_LIST
+from ..utils.instrumentation import timed
+
+# Characters that make a custom_sort pattern a wildcard
+WILDCARDS = re.compile(r"[*?\[]")
+
+# Text of a tag of a tag list
+TEXT = attrgetter("text")
+
+# Shuffling generators, reseeded for each prompt (creating one is slow)
+_local = threading.local()
 
 
 class CleanupPrompt:
     """
     A ComfyUI node to clean up your prompt.
     Sort tags and remove duplications
-    Inputs: string
-    Output: string
+    Inputs: string, or a tag list used instead
+    Outputs: string, tag list
     """
 
     @classmethod
@@ -28,48 +46,165 @@ class CleanupPrompt:
                     "max": 0xffffffffffffffff
                 })
             },
-            "optional": {}
+            "optional": {
+                "tags": (TAG_LIST,)
+            }
         }
 
-    RETURN_TYPES = ("STRING",)
-    RETURN_NAMES = ("string",)
+    RETURN_TYPES = ("STRING", TAG_LIST)
+    RETURN_NAMES = ("string", "tags")
     FUNCTION = "cleanup_prompt"
     CATEGORY = "⚙️ Prompt Factory/🛠️ Utils"
 
-    def cleanup_prompt(self, prompt, cleanup, sort, custom_sort, seed):
+    @timed("cleanup.cleanup_prompt")
+    def cleanup_prompt(self, prompt, cleanup, sort, custom_sort, seed,
+                       tags=None):
+        custom_sort = compile_custom_sort(custom_sort)
+
+        # Tag lists are sorted as they are, without parsing a prompt
+        if tags is not None:
+            tags = self._cleanup_tags(
+                list(tags), cleanup, sort, custom_sort, seed)
+            return (tags.text(), tags)
+
+        tags = self._sort_tags(
+            prompt.split(", "), cleanup, sort, custom_sort, seed)
+        return (
+            stringify_tags(tags, ", "),
+            TagList(Tag(tag, None, None) for tag in tags if tag)
+        )
 
-        tags = prompt.split(", ")
+    @timed("cleanup.cleanup_prompts")
+    def cleanup_prompts(self, prompts, cleanup, sort, custom_sort, seeds):
+        """
+        Clean up a list of prompts in one call
+        seeds is a seed per prompt, or a single seed for all of them.
+        Each prompt is the one cleanup_prompt() returns for its seed
+        """
+        if isinstance(seeds, int):
+            seeds = [seeds] * len(prompts)
+
+        custom_sort = compile_custom_sort(custom_sort)
+        return [
+            self._cleanup_prompt(prompt, cleanup, sort, custom_sort, seed)
+            for prompt, seed in zip(prompts, seeds)
+        ]
+
+    def _cleanup_prompt(self, prompt, cleanup, sort, custom_sort, seed):
+        tags = self._sort_tags(
+            prompt.split(", "), cleanup, sort, custom_sort, seed)
+        return stringify_tags(tags, ", ")
+
+    def _cleanup_tags(self, tags, cleanup, sort, custom_sort, seed):
+        "Clean up a tag list like the prompt of its tags"
+        return TagList(self._sort_tags(
+            tags, cleanup, sort, custom_sort, seed, key=TEXT))
+
+    def _sort_tags(self, tags, cleanup, sort, custom_sort, seed, key=None):
+        "Remove duplicates and sort tags, compared by key(tag)"
 
         if cleanup is True:
-            tags = self.remove_duplicates(tags)
+            tags = self.remove_duplicates(tags, key)
 
         match sort:
 
-            case "asc": tags = sorted(tags)
-            case "desc": tags = sorted(tags, reverse=True)
+            case "asc": tags = sorted(tags, key=key)
+            case "desc": tags = sorted(tags, key=key, reverse=True)
             case "random":
-                np.random.seed(seed)
-                np.random.shuffle(tags)
-
-        if custom_sort != "":
-            custom_sort = custom_sort.split(", ")
-            custom_order_dict = {}
-            for i, pattern in enumerate(custom_sort):
-                for tag in tags:
-                    if fnmatch.fnmatch(tag, pattern):
-                        custom_order_dict[tag] = i
-
-            tags = sorted(tags, key=lambda x:
-                          custom_order_dict.get(x, len(custom_order_dict)))
-
-        prompt = stringify_tags(tags, ", ")
-        return (prompt,)
-
-    def remove_duplicates(self, tags):
-        seen = set()
-        unique_tags = []
+                # Same shuffle as the global np.random, without sharing it
+                order = random_state(seed).permutation(len(tags))
+                tags = [tags[i] for i in order]
+
+        if custom_sort is not None:
+            tags = custom_sort.sort(tags, key)
+
+        return tags
+
+    def remove_duplicates(self, tags, key=None):
+        if key is None:
+            return list(dict.fromkeys(tags))
+        unique = {}
         for tag in tags:
-            if tag not in seen:
-                unique_tags.append(tag)
-                seen.add(tag)
-        return unique_tags
+            unique.setdefault(key(tag), tag)
+        return list(unique.values())
+
+
+class CustomSort:
+    """
+    Compiled custom_sort patterns
+    Patterns without wildcards are looked up in a dict, and the wildcards
+    are combined into a single regex. A tag is ranked by the last pattern
+    it matches, and tags matching none go last.
+    """
+
+    MAX_CACHED_TAGS = 4096
+
+    def __init__(self, patterns):
+        self.exact = {}
+        wildcards = {}
+        for i, pattern in enumerate(patterns):
+            pattern = os.path.normcase(pattern)
+            if WILDCARDS.search(pattern):
+                wildcards[pattern] = i
+            else:
+                self.exact[pattern] = i
+
+        # Alternatives by decreasing index: the first match is the last one
+        alternatives = sorted(wildcards.items(), key=lambda item: -item[1])
+        self.regex = re.compile("|".join(
+            f"(?P<p{i}>{fnmatch.translate(pattern)})"
+            for pattern, i in alternatives
+        )) if alternatives else None
+
+        self._ranks = {}
+
+    def rank(self, tag):
+        "Index of the last pattern matching the tag, or -1"
+        rank = self._ranks.get(tag)
+        if rank is not None:
+            return rank
+
+        name = os.path.normcase(tag)
+        rank = self.exact.get(name, -1)
+        if self.regex is not None:
+            match = self.regex.match(name)
+            if match is not None:
+                rank = max(rank, int(match.lastgroup[1:]))
+
+        if len(self._ranks) >= self.MAX_CACHED_TAGS:
+            self._ranks.clear()
+        self._ranks[tag] = rank
+        return rank
+
+    def sort(self, tags, key=None):
+        "Sort the tags by the patterns they match, keeping ties in order"
+        texts = tags if key is None else [key(tag) for tag in tags]
+        order = {}
+        for text in texts:
+            if text not in order:
+                rank = self.rank(text)
+                if rank >= 0:
+                    order[text] = rank
+
+        # Unmatched tags rank after the number of matched tags, as before
+        last = len(order)
+        ranks = [order.get(text, last) for text in texts]
+        indexes = sorted(range(len(tags)), key=ranks.__getitem__)
+        return [tags[i] for i in indexes]
+
+
+def random_state(seed):
+    "Return the generator of the current thread, reseeded"
+    state = getattr(_local, "random_state", None)
+    if state is None:
+        state = _local.random_state = np.random.RandomState()
+    state.seed(seed)
+    return state
+
+
+@lru_cache(maxsize=64)
+def compile_custom_sort(custom_sort):
+    "Return the compiled patterns of a custom_sort string, or None"
+    if custom_sort == "":
+        return None
+    return CustomSort(custom_sort.split(", "))
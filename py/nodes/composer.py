@@ -6,22 +6,43 @@ from ..utils.config import (
     RESERVED_KEYS
 )
 
-from .node_factory._variables import process_variables, apply_variables
-from .node_factory._tags import select_tags
+from .node_factory._variables import (
+    process_variables,
+    apply_variables,
+    substitute,
+    PLACEHOLDER
+)
+from ..utils.instrumentation import timed
+from .node_factory._compiler import compile_config
+from .node_factory._rules import current_rule_state
+from .node_factory._results import cached_result
+from .node_factory._context import (
+    HIDDEN_INPUTS,
+    execution_scope,
+    shared_variables
+)
+from .node_factory._tag_list import TagList, TAG_LIST
+from .node_factory._conditioning import conditioned_prompts
+
+# Where a {variable} can come from, by order of precedence
+NODES, TAGS, LOCALS, GLOBALS = range(4)
 
 
 class Composer:
     """
     A ComfyUI node to compose prompt with variables.
     Inputs: string with {variables}
-    Output: prompt composed with variables
+    Outputs: prompt composed with variables, and its tag list
     """
 
     def __init__(self):
         self.data = load_nodes_config()
 
-    RETURN_TYPES = ("STRING",)
-    RETURN_NAMES = ("string",)
+    # Variables available to the lazy mode, cached per config snapshot
+    _scopes_cache = None
+
+    RETURN_TYPES = ("STRING", TAG_LIST)
+    RETURN_NAMES = ("string", "tags")
     FUNCTION = "build_prompt"
     CATEGORY = "⚙️ Prompt Factory/🛠️ Utils"
 
@@ -37,63 +58,206 @@ class Composer:
                 }),
             },
             "optional": {
-            }
+                "lazy": ("BOOLEAN", {"default": False}),
+            },
+            "hidden": dict(HIDDEN_INPUTS)
         }
 
+    @timed("composer.build_prompt")
     def build_prompt(self, **args):
         """
         Transform tags, subtags and variables as reusable {variables}
         Return the prompt with the variables replaced
+        Lazy is disabled by default: every variable is resolved like in
+        previous versions, so a seed keeps giving the same prompt. The
+        lazy mode only resolves the variables of the prompt, drawing
+        other random numbers.
+        In ComfyUI, the nodes of an execution share the global variables
+        """
+        with execution_scope(args):
+            prompts = self.build_prompts(
+                args["prompt"], [args["seed"]], args.get("lazy", False))
+        return (prompts[0], TagList.from_text(prompts[0], "Composer"))
+
+    def build_prompts(self, prompt, seeds, lazy=False):
+        """
+        Compose the prompt once per seed
+        Each prompt is the one build_prompt() returns for that seed
+        """
+        build = self._build_prompt_lazy if lazy else self._build_prompt
+        inputs = {"prompt": prompt, "lazy": lazy}
+        return [
+            cached_result(
+                "composer", "Composer", inputs, seed,
+                lambda: build(
+                    np.random.default_rng(seed), prompt,
+                    shared_variables(seed)))
+            for seed in seeds
+        ]
+
+    def conditioned_prompts(self, prompt, n, include=(), exclude=(), seed=0,
+                            lazy=False, max_attempts=None):
+        """
+        Compose up to n prompts including every tag of include and none
+        of exclude
+        Composed prompts share their variables, so they are built by
+        seed and filtered: the report tells how many seeds were tried.
         """
-        rng = np.random.default_rng(args["seed"])
+        return conditioned_prompts(
+            None, lambda seeds: self.build_prompts(prompt, seeds, lazy),
+            n, include, exclude, seed, max_attempts)
+
+    def _build_prompt(self, rng, prompt, global_variables=None):
+        plans = compile_config(self.data)
+        select = plans.selector(current_rule_state())
 
         # Extract global and local variables
-        global_variables = load_variables_config()
-        local_variables = self._extract_local_variables(rng, global_variables)
+        if global_variables is None:
+            global_variables = load_variables_config()
+        local_variables = self._extract_local_variables(
+            rng, select, global_variables)
         variables = {**global_variables, **local_variables}
 
         # Also transforms tags as variables
-        tags = self._extract_tags(rng)
-        processed_tags = apply_variables(rng, tags, variables)
+        tags = self._extract_tags(rng, select)
+        processed_tags = apply_variables(rng, tags, variables, select)
 
         # Process whole node to use as variable
         nodes = {}
         for key, value in self.data.items():
-            nodes[key] = select_tags(rng, value)
+            nodes[key] = select(rng, value)
 
         # Merge everything and replace in prompt
         variables = {**variables, **processed_tags, **nodes}
-        prompt = args["prompt"]
-        prompt = apply_variables(rng, prompt, variables)
+        prompt = substitute(rng, prompt, variables, select=select)
 
-        return (prompt,)
+        return prompt
 
-    def _extract_local_variables(self, rng, global_variables):
+    def _extract_local_variables(self, rng, select, global_variables):
         processed_variables = {}
         for key in self.data.keys():
             if "variables" in self.data[key]:
                 local_variables = process_variables(
-                    rng, self.data[key]["variables"])
+                    rng, self.data[key]["variables"], select)
                 new_variable = apply_variables(
-                    rng, local_variables, global_variables)
+                    rng, local_variables, global_variables, select)
                 processed_variables.update(new_variable)
 
         return processed_variables
 
-    def _extract_tags(self, rng):
+    def _extract_tags(self, rng, select):
         tags = {}
         for key, value in self.data.items():
             if "tags" in self.data[key]:
                 for tag_key, tag_value in self.data[key]["tags"].items():
-                    tags[tag_key] = select_tags(rng, tag_value, p=1)
+                    tags[tag_key] = select(rng, tag_value, p=1)
                     if isinstance(tag_value, dict) and \
                        tag_value not in RESERVED_KEYS:
-                        self._process_sub_tags(rng, tags, tag_value)
+                        self._process_sub_tags(rng, select, tags, tag_value)
         return tags
 
-    def _process_sub_tags(self, rng, tags, sub_tags):
+    def _process_sub_tags(self, rng, select, tags, sub_tags):
         for sub_key, sub_value in sub_tags.items():
             if sub_key not in RESERVED_KEYS:
-                tags[sub_key] = select_tags(rng, sub_value, p=1)
+                tags[sub_key] = select(rng, sub_value, p=1)
                 if isinstance(sub_value, dict):
-                    self._process_sub_tags(rng, tags, sub_value)
+                    self._process_sub_tags(rng, select, tags, sub_value)
+
+    def _build_prompt_lazy(self, rng, prompt, global_variables=None):
+        """
+        Only resolve the {variables} used in the prompt, recursing into
+        the ones they contain. Values are memoized for this execution.
+        """
+        plans = compile_config(self.data)
+        select = plans.selector(current_rule_state())
+        scopes = self._scopes()
+        if global_variables is not None:
+            scopes = (*scopes[:GLOBALS], global_variables)
+        resolved = {}
+        resolving = set()
+
+        def resolve(layer, name):
+            "Value of a variable, before sampling for each occurrence"
+            key = (layer, name)
+            if key in resolved:
+                return resolved[key]
+
+            value = scopes[layer][name]
+            resolving.add(key)
+
+            if layer == NODES:
+                value = substitute(select(rng, value), LOCALS)
+            elif layer == TAGS:
+                value = substitute(select(rng, value, p=1), LOCALS)
+            elif layer == LOCALS and not is_unfixed(value):
+                value = substitute(select(rng, value), LOCALS)
+
+            resolving.discard(key)
+            resolved[key] = value
+            return value
+
+        def substitute(text, first_layer):
+            "Replace each {variable} found in the given scopes"
+
+            def replace(match):
+                name = match.group(1)
+                for layer in range(first_layer, len(scopes)):
+                    if name in scopes[layer]:
+                        break
+                else:
+                    return match.group(0)
+
+                # Keep variables referencing themselves as they are
+                if (layer, name) in resolving:
+                    return match.group(0)
+
+                value = resolve(layer, name)
+                if isinstance(value, str):
+                    return value
+
+                # Unfixed variables are sampled for each occurrence
+                resolving.add((layer, name))
+                value = substitute(select(rng, value), GLOBALS)
+                resolving.discard((layer, name))
+                return value
+
+            return PLACEHOLDER.sub(replace, text)
+
+        return substitute(prompt, NODES)
+
+    def _scopes(self):
+        "Index every {variable} by scope, without resolving any of them"
+        global_variables = load_variables_config()
+
+        cached = Composer._scopes_cache
+        if cached is not None and cached[0] is self.data and \
+           cached[1] is global_variables:
+            return cached[2]
+
+        nodes = dict(self.data)
+        tags = {}
+        local_variables = {}
+
+        for key, value in self.data.items():
+            local_variables.update(value.get("variables", {}))
+            if "tags" in value:
+                for tag_key, tag_value in value["tags"].items():
+                    tags[tag_key] = tag_value
+                    if isinstance(tag_value, dict):
+                        self._index_sub_tags(tags, tag_value)
+
+        scopes = (nodes, tags, local_variables, dict(global_variables))
+        Composer._scopes_cache = (self.data, global_variables, scopes)
+        return scopes
+
+    def _index_sub_tags(self, tags, sub_tags):
+        for sub_key, sub_value in sub_tags.items():
+            if sub_key not in RESERVED_KEYS:
+                tags[sub_key] = sub_value
+                if isinstance(sub_value, dict):
+                    self._index_sub_tags(tags, sub_value)
+
+
+def is_unfixed(value):
+    "Unfixed variables are sampled again for each occurrence"
+    return isinstance(value, dict) and not value.get("fixed", True)
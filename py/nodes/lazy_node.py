@@ -0,0 +1,73 @@
+import threading
+import importlib
+
+
+class LazyNode:
+    """
+    Stand-in for a node class registered from the manifest
+    ComfyUI can list and validate it from the cached schema. The real
+    node class (and numpy with it) is only imported when the node is
+    first executed, then the stand-in delegates everything to it.
+    """
+
+    id = None
+    module = None
+    class_name = None
+    inputs = None
+
+    # Real node class, once imported
+    node_class = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        if cls.node_class is not None:
+            return cls.node_class.INPUT_TYPES()
+        return {
+            section: {
+                key: tuple(value) if isinstance(value, list) else value
+                for key, value in inputs.items()
+            }
+            for section, inputs in cls.inputs.items()
+        }
+
+    @classmethod
+    def load_node_class(cls):
+        "Import the real node class"
+        if cls.node_class is None:
+            with cls._lock:
+                if cls.node_class is None:
+                    cls.node_class = import_node_class(
+                        cls.id, cls.name, cls.module, cls.class_name)
+        return cls.node_class
+
+    def __getattr__(self, name):
+        if name == "node":
+            self.node = self.load_node_class()()
+            return self.node
+        return getattr(self.node, name)
+
+
+def import_node_class(node_id, name, module, class_name):
+    "Import a node class, or create it with the node factory"
+    module = importlib.import_module(f".{module}", __package__)
+    if class_name is None:
+        return module.NodeFactory.create_node(node_id, name)
+    return getattr(module, class_name)
+
+
+def create_lazy_node(entry):
+    "Create the stand-in class of a manifest entry"
+    attributes = {
+        key: tuple(value) if isinstance(value, list) else value
+        for key, value in entry["attributes"].items()
+    }
+    return type(entry["id"], (LazyNode,), {
+        **attributes,
+        "id": entry["id"],
+        "name": entry["name"],
+        "module": entry["module"],
+        "class_name": entry["class"],
+        "inputs": entry["inputs"],
+        "_lock": threading.Lock(),
+    })
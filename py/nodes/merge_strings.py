@@ -1,12 +1,15 @@
+from .node_factory._tag_list import TagList, TAG_LIST
+
+
 class MergeStrings:
     """
     A ComfyUI node to merge string.
-    Inputs: strings (stacked)
-    Output: merged string
+    Inputs: strings or tag lists (stacked)
+    Outputs: merged string, merged tag list
     Check merge_strings.js for the frontend implementation.
     """
-    RETURN_TYPES = ("STRING",)
-    RETURN_NAMES = ("string",)
+    RETURN_TYPES = ("STRING", TAG_LIST)
+    RETURN_NAMES = ("string", "tags")
     FUNCTION = "merge_strings"
     CATEGORY = "⚙️ Prompt Factory/🛠️ Utils"
 
@@ -20,8 +23,16 @@ class MergeStrings:
         }
 
     def merge_strings(self, separator, **kwargs):
-        value = separator.join(
+        values = [
             v for v in kwargs.values()
-            if isinstance(v, str)
+            if isinstance(v, (str, TagList))
+        ]
+        value = separator.join(
+            v if isinstance(v, str) else v.text() for v in values
         )
-        return (value,)
+
+        # Tag lists are merged as they are, strings are split into tags
+        tags = []
+        for v in values:
+            tags.extend(v if isinstance(v, TagList) else TagList.from_text(v))
+        return (value, TagList(tags))
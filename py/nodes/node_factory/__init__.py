@@ -1,19 +1,52 @@
 import numpy as np
 
-from ...utils.config import load_nodes_config
-from ._inputs import build_inputs, apply_input_values
+from ...utils.config import load_node_config
+from ...utils.instrumentation import timed, stage, count
+from ._inputs import build_inputs, input_overlay
 from ._variables import load_variables, apply_variables
-from ._tags import select_tags, stringify_tags
+from ._tags import stringify_tags
+from ._compiler import compile_config
+from ._rules import current_rule_state
+from ._results import cached_result
+from ._space import node_space, unique_prompts
+from ._context import HIDDEN_INPUTS, execution_scope, shared_variables
+from ._report import tag_report, SAMPLES
+from ._tag_list import TagList, TAG_LIST, split_tags
+from ._streams import Streams, streams_enabled, value_key
+from ._conditioning import conditioned_prompts
 
 
 class NodeFactory:
 
     def __init__(self):
-        config = load_nodes_config()
-        self.data = config[self.__class__.__name__.lower()]
+        self.data = load_node_config(self.__class__.__name__.lower())
+
+    # (node config, input schema) the schema was built from
+    _input_types = None
 
     @classmethod
     def INPUT_TYPES(cls):
+        """
+        Return the node inputs, built once per config of the node
+        The schema is rebuilt when the config file of the node changes.
+        Callers get a copy of the sections, the input options are shared
+        and must not be modified.
+        """
+        data = load_node_config(cls.__name__.lower())
+        cached = cls._input_types
+        if cached is not None and cached[0] is data:
+            count("inputs.hit")
+        else:
+            count("inputs.miss")
+            cached = (data, cls._build_input_types())
+            cls._input_types = cached
+
+        return {
+            section: dict(inputs) for section, inputs in cached[1].items()
+        }
+
+    @classmethod
+    def _build_input_types(cls):
         instance = cls()
         inputs = build_inputs(instance)
         inputs["required"]["seed"] = ("INT", {
@@ -21,41 +54,166 @@ class NodeFactory:
             "min": 0,
             "max": 0xffffffffffffffff
         })
+        inputs["hidden"] = dict(HIDDEN_INPUTS)
         return inputs
 
-    RETURN_TYPES = ("STRING",)
+    RETURN_TYPES = ("STRING", TAG_LIST)
     FUNCTION = "build_prompt"
     CATEGORY = "⚙️ Prompt Factory/⭐️ My Nodes"
 
+    @timed("node.build_prompt")
     def build_prompt(self, **args):
         """
         Build the prompt according to the node inputs
-        Concatenate the tags and return the prompt
+        Concatenate the tags and return the prompt, and its tag list
+        In ComfyUI, the nodes of an execution share the global variables
         """
+        node_id = self.__class__.__name__
+        with execution_scope(args):
+            prompt, tags = cached_result(
+                "node", node_id, args, args["seed"],
+                lambda: self._build_result_from_args(args))
+        return (prompt, TagList.from_pairs(node_id, tags))
+
+    def _build_result_from_args(self, args):
         rng = np.random.default_rng(args["seed"])
 
         # Build inputs
-        input_values = apply_input_values(self.data["tags"], args)
+        with stage("node.inputs"):
+            inputs = input_overlay(self.data["tags"], args)
+
+        return self._build_result(rng, inputs, args["seed"])
+
+    def build_prompts(self, seeds, **args):
+        """
+        Build one prompt per seed, with the same node inputs
+        Each prompt is the one build_prompt() returns for that seed
+        """
+        inputs = input_overlay(self.data["tags"], args)
+
+        def build(seed):
+            return self._build_result(
+                np.random.default_rng(seed), inputs, seed)
+
+        return [
+            cached_result(
+                "node", self.__class__.__name__, args, seed,
+                lambda: build(seed))[0]
+            for seed in seeds
+        ]
+
+    def space(self, **args):
+        """
+        Return the space of the prompts the node can build
+        None when the node can't be indexed (see _space.py)
+        """
+        return node_space(self.data, args)
 
-        # Select tags
-        tags = {}
-        for key, value in input_values.items():
-            tags[key] = select_tags(rng, value)
+    def unique_prompts(self, n, seed=0, **args):
+        """
+        Build up to n distinct prompts, with the same node inputs
+        Prompts are drawn without replacement when the node's space is
+        indexed, and deduplicated otherwise.
+        """
+        return unique_prompts(
+            self.space(**args),
+            lambda seeds: self.build_prompts(seeds, **args),
+            n, seed)
+
+    def conditioned_prompts(self, n, include=(), exclude=(), seed=0,
+                            max_attempts=None, **args):
+        """
+        Build up to n prompts including every tag of include and none of
+        exclude, with the same node inputs
+        Return the rows {"prompt", "token", "seed"} and a report telling
+        how they were drawn (see _conditioning.py): a token is the index
+        of its prompt in space(), a seed is given to build_prompt().
+        """
+        return conditioned_prompts(
+            self.space(**args),
+            lambda seeds: self.build_prompts(seeds, **args),
+            n, include, exclude, seed, max_attempts)
+
+    def tag_report(self, samples=SAMPLES, **args):
+        """
+        Return the probability of each tag to be picked, with the same
+        node inputs (see _report.py)
+        """
+        return tag_report(self.data, args, self._build_prompt, samples)
+
+    def _build_prompt(self, rng, inputs, seed=None):
+        return self._build_result(rng, inputs, seed)[0]
+
+    def _build_result(self, rng, inputs, seed=None):
+        """
+        Return [prompt, (tag, group path) of each tag], as they are
+        cached: the tags are the ones rendered by the compiled plans
+        With the group streams on, each group draws from its own stream
+        and is cached on its own, so changing an input only builds its
+        group again (see _streams.py)
+        """
+        streams = None
+        if seed is not None and streams_enabled():
+            streams = Streams(seed, self.__class__.__name__)
+
+        # Select tags, applying the rules triggered along the way
+        with stage("node.tags"):
+            plans = compile_config(self.data)
+            state = current_rule_state()
+            select = plans.selector(state)
+            tags = {}
+            parts = {}
+            for key, value, probability in inputs:
+                if streams is None:
+                    parts[key] = []
+                    tags[key] = plans.select(
+                        rng, value, probability, state, parts[key], key)
+                else:
+                    tags[key], parts[key] = self._select_group(
+                        plans, state, streams, key, value, probability)
 
         # Replace tags with corresponding variables
-        variables = load_variables(rng, self.data)
-        tags = apply_variables(rng, tags, variables)
+        with stage("node.variables"):
+            variables = load_variables(
+                rng, self.data, select, shared_variables(seed),
+                streams and streams.child("variables"))
+            replaced = apply_variables(
+                rng, tags, variables, select,
+                streams and streams.child("tags"))
+
+        # Groups changed by their variables are only known from their text
+        for key, text in replaced.items():
+            if text is not tags[key] and text != tags[key]:
+                parts[key] = [(tag, key) for tag in split_tags(text)]
+
+        # Build and clean-up final prompt, as a plain string
+        with stage("node.stringify"):
+            prompt = str(stringify_tags(replaced.values(), ", "))
+        return [prompt, [pair for key in parts for pair in parts[key]]]
+
+    def _select_group(self, plans, state, streams, key, value,
+                      probability):
+        "Text and tags of a group drawn from its stream, cached"
+        def build():
+            group_parts = []
+            text = plans.select(
+                streams("groups", key), value, probability, state,
+                group_parts, key)
+            return [text, group_parts]
 
-        # Build and clean-up final prompt
-        prompt = stringify_tags(tags.values(), ", ")
-        return (prompt,)
+        return cached_result(
+            "group", f"{self.__class__.__name__}/{key}",
+            {"value": value_key(value), "probability": probability},
+            streams.seed, build)
 
     @classmethod
     def create_node(cls, node_id, node_name=None):
-        "Create a new node with ID and name"
-        return type(node_id, (cls,), {
+        "Create a new node with ID and name, and build its inputs"
+        node_class = type(node_id, (cls,), {
             "id": node_id,
             "name": node_name or node_id.capitalize()
         })
+        node_class.INPUT_TYPES()
+        return node_class
 
     __all__ = ["NodeFactory"]
@@ -0,0 +1,595 @@
+import threading
+from bisect import bisect_right
+from collections.abc import Mapping
+from functools import lru_cache
+
+import numpy as np
+
+from ...utils.config import RESERVED_KEYS
+from ...utils.instrumentation import count
+from ._tags import select_tags, stringify_tags, CleanTags, is_clean
+from ._vocabulary import load_vocabulary
+from ._tag_list import split_tags
+
+
+class TagPlan:
+    """
+    Precomputed selection plan of a tag group
+    Everything that doesn't depend on the seed (normalized distribution,
+    cumulative weights, affixes...) is resolved once when compiling, so
+    sampling only has to draw random numbers.
+    Sampling consumes the random generator exactly like select_tags().
+    An optional view (e.g. the rules fired during an execution) can
+    substitute plans, and is told which tags are picked.
+    Given a parts list, the rendered tags are appended to it with the
+    path of the group they come from, e.g. "outfit/top".
+    Plans implement select(rng, view, parts, path), sample() drawing
+    the probability of the group first.
+    """
+
+    __slots__ = ("probability", "data")
+
+    def sample(self, rng, p=None, view=None, parts=None, path=""):
+        "Select tags and return them as a string"
+        if view is not None:
+            plan = view.resolve(self)
+            if plan is not self:
+                return plan.sample(rng, p, view, parts, path)
+
+        if p is None:
+            p = self.probability
+
+        if rng.random() > p:
+            return ""
+
+        return self.select(rng, view, parts, path)
+
+
+class FallbackPlan(TagPlan):
+    "Plan for data the compiler doesn't handle: delegate to select_tags()"
+
+    __slots__ = ()
+
+    def __init__(self, data):
+        self.data = data
+
+    def sample(self, rng, p=None, view=None, parts=None, path=""):
+        if view is not None:
+            plan = view.resolve(self)
+            if plan is not self:
+                return plan.sample(rng, p, view, parts, path)
+
+        text = select_tags(rng, self.data, p)
+
+        # The tags of the group are only known from its text
+        if parts is not None:
+            parts.extend((tag, path) for tag in split_tags(text))
+        return text
+
+
+class ChoicePlan(TagPlan):
+    "Base plan for groups choosing n tags among a fixed number of options"
+
+    __slots__ = (
+        "size", "number", "p", "cdf", "cdf_list", "nonzero",
+        "prefix", "suffix", "separator"
+    )
+
+    def __init__(self, data, size, source=None):
+        self.data = data if source is None else source
+        self.probability = data.get("probability", 1)
+        self.size = size
+        self.prefix = data.get("prefix", "")
+        self.suffix = data.get("suffix", "")
+        self.separator = data.get("separator", ",")
+
+        self.number = number_setting(data, size)
+
+        # Distribution, normalized the same way select_tags() does
+        d = data.get("distribution", np.ones(size))
+        if np.sum(d) > 1:
+            d = d / np.sum(d)
+            d = np.append(d, np.zeros(size - len(d)))
+        elif len(d) < size:
+            n_remaining_tags = size - len(d)
+            remaining_d = 1 - np.sum(d)
+            d = np.append(
+                d, np.full(
+                    n_remaining_tags,
+                    remaining_d / n_remaining_tags
+                )
+            )
+        self.p = np.array(d, dtype=np.float64)
+
+        # Invalid distributions are left to rng.choice() to raise
+        try:
+            if "distribution" in data:
+                np.random.default_rng(0).choice(
+                    size, size=0, p=self.p, replace=False)
+        except ValueError:
+            self.cdf = None
+            self.cdf_list = None
+            self.nonzero = 0
+            return
+
+        self.cdf = np.cumsum(self.p)
+        self.cdf /= self.cdf[-1]
+        self.cdf_list = self.cdf.tolist()
+        self.nonzero = int(np.count_nonzero(self.p > 0))
+
+    def draw_number(self, rng):
+        "Number of tags to select"
+        if isinstance(self.number, tuple):
+            return rng.integers(*self.number)
+        return self.number
+
+    def choose(self, rng, n):
+        """
+        Draw n distinct indexes
+        Same draws and result as rng.choice(size, n, p=p, replace=False)
+        """
+        if n == 1 and self.cdf is not None:
+            return [bisect_right(self.cdf_list, rng.random())]
+
+        if self.cdf is None or n > self.nonzero:
+            return rng.choice(
+                self.size, size=n, p=self.p, replace=False).tolist()
+
+        found = []
+        p = self.p
+        cdf = self.cdf
+        while len(found) < n:
+            x = rng.random(n - len(found))
+            if found:
+                p = p.copy()
+                p[found] = 0
+                cdf = np.cumsum(p)
+                cdf /= cdf[-1]
+            new = cdf.searchsorted(x, side="right")
+            _, unique_indices = np.unique(new, return_index=True)
+            unique_indices.sort()
+            found.extend(new.take(unique_indices).tolist())
+        return found
+
+
+class LeafPlan(ChoicePlan):
+    """
+    Plan for a list of tags
+    Compiling is linear in the number of tags, and the strings of the
+    picked tags are only built when they are picked, so lists of
+    100k tags (e.g. artist vocabularies) compile once and sample in
+    O(log n) per tag.
+    Selection works on tag indexes: the rendered text of each index is
+    kept in a table, and picked tags are joined once at the end.
+    """
+
+    __slots__ = ("tags", "order", "single")
+
+    def __init__(self, data, tags, source=None):
+        super().__init__(data, len(tags), source)
+        self.tags = tags
+        self.order = tag_order(tags)
+        self.single = {}
+
+    def affixed(self, i):
+        return f"{self.prefix}{self.tags[i]}{self.suffix}"
+
+    def text(self, i):
+        "Tag i rendered on its own, clean tags are marked as such"
+        tag = self.single.get(i)
+        if tag is None:
+            tag = self.affixed(i)
+            if is_clean(tag):
+                tag = CleanTags(tag)
+            else:
+                tag = stringify_tags([tag], self.separator)
+            if len(self.single) < MAX_SINGLE_TAGS:
+                self.single[i] = tag
+        return tag
+
+    def select(self, rng, view=None, parts=None, path=""):
+        n = self.draw_number(rng)
+        indexes = self.choose(rng, n)
+
+        if view is not None:
+            for i in indexes:
+                view.picked(self.tags[i])
+
+        if len(indexes) == 1:
+            text = self.text(indexes[0])
+            if parts is not None and text:
+                parts.append((text, path))
+            return text
+
+        if self.order is None:
+            indexes.sort()
+        else:
+            indexes.sort(key=self.order.__getitem__)
+
+        # Tags changed by the clean up are joined from their raw text
+        tags = selected_tags = [self.text(i) for i in indexes]
+        if not all(tag.__class__ is CleanTags for tag in selected_tags):
+            selected_tags = [self.affixed(i) for i in indexes]
+        text = stringify_tags(selected_tags, self.separator)
+
+        if parts is not None:
+            join_parts(parts, text, [(tag, path) for tag in tags],
+                       self.separator, path, clean=False)
+        return text
+
+
+class VocabularyPlan(TagPlan):
+    """
+    Plan for a group whose tags are in an external vocabulary file
+    The vocabulary is looked up when sampling, so a changed file is
+    picked up without recompiling the config.
+    """
+
+    __slots__ = ("name", "bound")
+
+    def __init__(self, data):
+        self.data = data
+        self.probability = data.get("probability", 1)
+        self.name = data["vocabulary"]
+        self.bound = None
+
+    def select(self, rng, view=None, parts=None, path=""):
+        vocabulary = load_vocabulary(self.name)
+        bound = self.bound
+        if bound is None or bound.vocabulary is not vocabulary:
+            bound = self.bound = VocabularyChoice(self.data, vocabulary)
+        return bound.select(rng, view, parts, path)
+
+
+class VocabularyChoice(ChoicePlan):
+    "Choice among the tags of a loaded vocabulary, picked in file order"
+
+    __slots__ = ("vocabulary",)
+
+    def __init__(self, data, vocabulary):
+        self.data = data
+        self.probability = data.get("probability", 1)
+        self.vocabulary = vocabulary
+        self.size = vocabulary.size
+        self.prefix = data.get("prefix", "")
+        self.suffix = data.get("suffix", "")
+        self.separator = data.get("separator", ",")
+        self.number = number_setting(data, self.size)
+        self.p = vocabulary.p
+        self.cdf = vocabulary.cdf
+        self.cdf_list = None
+        self.nonzero = vocabulary.nonzero
+
+    def choose(self, rng, n):
+        if n == 1:
+            return [int(self.cdf.searchsorted(rng.random(), side="right"))]
+        return super().choose(rng, n)
+
+    def select(self, rng, view=None, parts=None, path=""):
+        if not self.size:
+            return ""
+
+        indexes = sorted(self.choose(rng, self.draw_number(rng)))
+        tags = [self.vocabulary.tag(i) for i in indexes]
+
+        if view is not None:
+            for tag in tags:
+                view.picked(tag)
+
+        selected_tags = [f"{self.prefix}{tag}{self.suffix}" for tag in tags]
+        if len(selected_tags) == 1 and is_clean(selected_tags[0]):
+            text = CleanTags(selected_tags[0])
+        else:
+            text = stringify_tags(selected_tags, self.separator)
+
+        if parts is not None:
+            join_parts(parts, text, [(tag, path) for tag in selected_tags],
+                       self.separator, path)
+        return text
+
+
+def number_setting(data, size):
+    "Number of tags to select: an int, or a (min, max) range"
+    n = data.get("number", 1)
+    if isinstance(n, int) and n > size:
+        n = size
+    if isinstance(n, list):
+        n = (int(n[0]), int(min(n[1], size)))
+    return n
+
+
+# Formatted tags kept by a plan, to bound the memory of large lists
+MAX_SINGLE_TAGS = 4096
+
+# Paths of sub-groups kept by a plan, a plan being shared by its paths
+MAX_PATHS = 64
+
+# From this size, picked tags are ordered by their index in the list
+LARGE_GROUP = 1024
+
+
+def tag_order(tags):
+    """
+    Sort key of the picked tags, None to sort them by index
+    Small lists with duplicate tags sort them by their first occurrence,
+    like select_tags() does.
+    """
+    first = {}
+    for i, tag in enumerate(tags):
+        first.setdefault(tag, i)
+    if len(first) == len(tags) or len(tags) >= LARGE_GROUP:
+        return None
+    return [first[tag] for tag in tags]
+
+
+class GroupPlan(ChoicePlan):
+    "Plan for a group of sub-groups, picking among their results"
+
+    __slots__ = ("children", "labels", "paths")
+
+    def __init__(self, data, children, source=None):
+        super().__init__(data, len(children), source)
+        self.children = children
+        self.labels = list(data["tags"].keys())
+        self.paths = {}
+
+    def select(self, rng, view=None, parts=None, path=""):
+        if parts is None:
+            tags = [child.sample(rng, view=view) for child in self.children]
+        else:
+            child_parts = [[] for _ in self.children]
+            child_paths = sub_paths(self.paths, path, self.labels)
+            tags = [
+                child.sample(rng, None, view, child_parts[i], child_paths[i])
+                for i, child in enumerate(self.children)
+            ]
+
+        n = self.draw_number(rng)
+        indexes = self.choose(rng, n)
+
+        if view is not None:
+            for i in indexes:
+                view.picked(self.labels[i])
+
+        # Ordered by the first sub-group giving the same tags
+        first = {}
+        for i, tag in enumerate(tags):
+            first.setdefault(tag, i)
+        indexes.sort(key=lambda i: first[tags[i]])
+        selected_tags = [tags[i] for i in indexes]
+
+        if self.prefix or self.suffix:
+            selected_tags = [
+                f"{self.prefix}{tag}{self.suffix}" for tag in selected_tags
+            ]
+        text = stringify_tags(selected_tags, self.separator)
+
+        if parts is not None:
+            join_parts(parts, text, [
+                part for i in indexes for part in affix_parts(
+                    child_parts[i], self.prefix, self.suffix,
+                    child_paths[i])
+            ], self.separator, path, self.prefix or self.suffix)
+        return text
+
+
+class RecursivePlan(TagPlan):
+    "Plan for a group without tags, where every key is a sub-group"
+
+    __slots__ = (
+        "children", "keys", "paths", "prefix", "suffix", "separator"
+    )
+
+    def __init__(self, data, children, keys):
+        self.data = data
+        self.probability = data.get("probability", 1)
+        self.children = children
+        self.keys = keys
+        self.paths = {}
+        self.prefix = data.get("prefix", "")
+        self.suffix = data.get("suffix", "")
+        self.separator = data.get("separator", ",")
+
+    def select(self, rng, view=None, parts=None, path=""):
+        if parts is None:
+            selected_tags = [
+                child.sample(rng, view=view) for child in self.children
+            ]
+        else:
+            child_parts = [[] for _ in self.children]
+            child_paths = sub_paths(self.paths, path, self.keys)
+            selected_tags = [
+                child.sample(rng, None, view, child_parts[i], child_paths[i])
+                for i, child in enumerate(self.children)
+            ]
+
+        if self.prefix or self.suffix:
+            selected_tags = [
+                f"{self.prefix}{tag}{self.suffix}" for tag in selected_tags
+            ]
+        text = stringify_tags(selected_tags, self.separator)
+
+        if parts is not None:
+            join_parts(parts, text, [
+                part for i, child_path in enumerate(child_paths)
+                for part in affix_parts(
+                    child_parts[i], self.prefix, self.suffix, child_path)
+            ], self.separator, path, self.prefix or self.suffix)
+        return text
+
+
+def sub_paths(paths, path, keys):
+    "Paths of the sub-groups of a group, kept by the plan for each path"
+    child_paths = paths.get(path)
+    if child_paths is None:
+        child_paths = [f"{path}/{key}" if path else key for key in keys]
+        if len(paths) < MAX_PATHS:
+            paths[path] = child_paths
+    return child_paths
+
+
+def affix_parts(parts, prefix, suffix, path):
+    """
+    Parts of a sub-group once its text is affixed: the prefix goes to
+    its first tag and the suffix to its last one
+    """
+    if not (prefix or suffix):
+        return parts
+    if not parts:
+        return [(f"{prefix}{suffix}", path)]
+
+    parts = list(parts)
+    text, tag_path = parts[0]
+    parts[0] = (f"{prefix}{text}", tag_path)
+    text, tag_path = parts[-1]
+    parts[-1] = (f"{text}{suffix}", tag_path)
+    return parts
+
+
+def join_parts(parts, text, tags, separator, path, clean=True):
+    """
+    Append the (tag, path) of a group joining tags into text
+    Tags joined by a comma are kept apart, each cleaned up like the
+    text unless they already are, while other separators merge them
+    into a single tag.
+    """
+    if separator not in (",", ", "):
+        if text:
+            parts.append((text, path))
+        return
+
+    if not clean:
+        parts.extend(tag for tag in tags if tag[0])
+        return
+
+    for tag, tag_path in tags:
+        if tag.__class__ is not CleanTags and not is_clean(tag):
+            tag = stringify_tags([tag], separator)
+        if tag:
+            parts.append((tag, tag_path))
+
+
+def compile_tags(data, plans=None):
+    """
+    Compile a tag group into a plan
+    Sub-groups are looked up in plans when given
+    """
+    lookup = plans.plan if plans is not None else compile_tags
+
+    if isinstance(data, str):
+        return _compile_string(data)
+
+    source = data
+    if isinstance(data, list):
+        data = {"tags": data}
+
+    if not isinstance(data, dict):
+        return FallbackPlan(data)
+
+    if "vocabulary" in data and "tags" not in data:
+        return VocabularyPlan(data)
+
+    tags = data.get("tags", [])
+    if isinstance(tags, str):
+        tags = [tags]
+
+    try:
+        if isinstance(tags, list) and tags:
+            if _is_plain_list(tags):
+                return LeafPlan(data, tags, source)
+
+        elif isinstance(tags, dict) and tags and not tags.get("tags"):
+            children = [lookup(value) for value in tags.values()]
+            return GroupPlan(data, children, source)
+
+        elif not tags and "tags" not in data and \
+                isinstance(data.get("number", 1), int) and \
+                "distribution" not in data:
+            keys = [key for key in data if key not in RESERVED_KEYS]
+            return RecursivePlan(
+                data, [lookup(data[key]) for key in keys], keys)
+
+    # Invalid settings raise when the group is sampled, as before
+    except (ValueError, TypeError):
+        pass
+
+    return FallbackPlan(source)
+
+
+@lru_cache(maxsize=4096)
+def _compile_string(tag):
+    return LeafPlan({}, [tag], tag)
+
+
+def _is_plain_list(tags):
+    "Only strings keep the same values once converted by numpy"
+    return all(isinstance(tag, str) and not tag.endswith("\0")
+               for tag in tags)
+
+
+class TagPlans:
+    """
+    Compiled plans of a config tree, looked up by identity
+    Only the objects belonging to the config are cached, other data
+    (e.g. a selected input value) is compiled on the fly.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self._owned = set()
+        self._plans = {}
+        self._collect(data)
+
+    def _collect(self, data):
+        self._owned.add(id(data))
+        if isinstance(data, Mapping):
+            for value in data.values():
+                self._collect(value)
+        elif isinstance(data, list):
+            # Tags of a list are never looked up on their own
+            for value in data:
+                if not isinstance(value, str):
+                    self._collect(value)
+
+    def plan(self, data):
+        "Return the plan of a tag group"
+        key = id(data)
+        plan = self._plans.get(key)
+        if plan is None:
+            plan = compile_tags(data, self)
+            if key in self._owned:
+                self._plans[key] = plan
+        return plan
+
+    def select(self, rng, data, p=None, view=None, parts=None, path=""):
+        "Compiled equivalent of select_tags()"
+        return self.plan(data).sample(rng, p, view, parts, path)
+
+    def selector(self, view=None):
+        "Return a select_tags() like function bound to a view"
+        if view is None:
+            return self.select
+        return lambda rng, data, p=None: self.select(rng, data, p, view)
+
+
+_compiled = {}
+_compiled_lock = threading.Lock()
+MAX_COMPILED = 64
+
+
+def compile_config(data):
+    "Return the (cached) compiled plans of a config tree"
+    entry = _compiled.get(id(data))
+    if entry is not None and entry.data is data:
+        count("compile.hit")
+        return entry
+
+    with _compiled_lock:
+        entry = _compiled.get(id(data))
+        if entry is None or entry.data is not data:
+            count("compile.miss")
+            entry = TagPlans(data)
+            if len(_compiled) >= MAX_COMPILED:
+                del _compiled[next(iter(_compiled))]
+            _compiled[id(data)] = entry
+    return entry
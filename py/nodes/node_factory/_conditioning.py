@@ -0,0 +1,526 @@
+from math import comb
+
+import numpy as np
+
+from ._space import Space, OptionalSpace, LeafSpace, GroupSpace, ProductSpace
+from ._report import subset_probabilities, EXACT_OPTIONS
+
+# Separators keeping the tags of the parts they join apart
+SEPARATORS = (",", ", ")
+
+# Included tags tracked at once: parts have up to 2 ** n states
+MAX_INCLUDED_TAGS = 16
+
+# Prompts built per batch, and seeds tried by default, by the fallback
+BATCH_SIZE = 256
+MAX_ATTEMPTS = 10000
+
+
+class NotExact(Exception):
+    "The conditioned distribution of a space can't be computed"
+
+
+def prompt_tags(prompt):
+    "Tags of a prompt, as they are split on commas"
+    return {tag.strip() for tag in prompt.split(",")} - {""}
+
+
+class Constraints:
+    """
+    Tags a prompt must include, and tags it must not
+    A part of a prompt covers a bit mask of the included tags, or None
+    when it outputs an excluded one.
+    """
+
+    def __init__(self, include=(), exclude=()):
+        self.include = list(dict.fromkeys(
+            tag.strip() for tag in include if tag.strip()))
+        self.exclude = frozenset(
+            tag.strip() for tag in exclude if tag.strip())
+        self.bits = {tag: 1 << i for i, tag in enumerate(self.include)}
+        self.full = (1 << len(self.include)) - 1
+
+    def matches(self, prompt):
+        tags = prompt_tags(prompt)
+        return tags.issuperset(self.include) and self.exclude.isdisjoint(tags)
+
+    def cover(self, text):
+        "Included tags of a text, None if it has an excluded one"
+        mask = 0
+        for tag in text.split(","):
+            tag = tag.strip()
+            if tag in self.exclude:
+                return None
+            mask |= self.bits.get(tag, 0)
+        return mask
+
+
+# Distribution of a part that can't output a constrained tag
+NEUTRAL = {0: 1.0}
+
+
+def convolve(a, b):
+    "Distribution of the included tags of two independent parts"
+    if b is NEUTRAL:
+        return a
+    c = {}
+    for sa, ma in a.items():
+        for sb, mb in b.items():
+            c[sa | sb] = c.get(sa | sb, 0.0) + ma * mb
+    return c
+
+
+def subset_tables(items, size):
+    """
+    tables[i][j]: distribution of the included tags of j items among
+    items[i:], summed over the subsets of j items
+    """
+    tables = [None] * len(items) + [[{0: 1.0}]]
+    for i in range(len(items) - 1, -1, -1):
+        following = tables[i + 1]
+        table = [dict(d) for d in following]
+        if len(table) <= size:
+            table.append({})
+        for j, d in enumerate(following[:size]):
+            for state, mass in convolve(items[i], d).items():
+                table[j + 1][state] = table[j + 1].get(state, 0.0) + mass
+        tables[i] = table
+    return tables
+
+
+def covering(distribution, acc, target):
+    "Mass of the states completing acc into target"
+    return sum(
+        mass for state, mass in distribution.items()
+        if acc | state == target
+    )
+
+
+def pick(rng, weights):
+    "Index of a weight, drawn in proportion to the weights"
+    total = sum(weights)
+    if total <= 0:
+        raise NotExact("Sampling a combination without probability")
+    u = rng.random() * total
+    for i, weight in enumerate(weights):
+        u -= weight
+        if u < 0 and weight > 0:
+            return i
+    return max(i for i, weight in enumerate(weights) if weight > 0)
+
+
+def draw_subset(items, tables, j, target, rng):
+    """
+    Pick j items and the state of each, their union being the target
+    Subsets are drawn in proportion to their mass. Return the
+    (index, state) pairs of the items picked, by index.
+    """
+    picked = []
+    acc = 0
+    for i, item in enumerate(items):
+        if j == 0:
+            break
+        following = tables[i + 1]
+        choices = []
+        weights = []
+        if j < len(following):
+            choices.append(None)
+            weights.append(covering(following[j], acc, target))
+        for state, mass in item.items():
+            if (acc | state) & ~target or j - 1 >= len(following):
+                continue
+            choices.append(state)
+            weights.append(
+                mass * covering(following[j - 1], acc | state, target))
+
+        state = choices[pick(rng, weights)]
+        if state is not None:
+            picked.append((i, state))
+            acc |= state
+            j -= 1
+    return picked
+
+
+class Draw:
+    """
+    How n options are drawn among the options of a group
+    Draws are weighted without replacement, like rng.choice(), so they
+    are only conditioned exactly when: a single option is drawn, every
+    option is, the options are as likely, or there are few of them.
+    items are the distributions of the options.
+    """
+
+    def __init__(self, q, n, items):
+        k = len(items)
+        self.q = q
+        self.n = n
+        self.items = items
+        self.neutral = all(item is NEUTRAL for item in items)
+
+        if n == 0 or self.neutral:
+            self.kind = "free"
+            self.cdf = np.cumsum(q)
+            self.distribution = NEUTRAL
+        elif n == 1:
+            self.kind = "single"
+            self.cdfs = {}
+            self.distribution = {}
+            for weight, item in zip(q.tolist(), items):
+                for state, mass in item.items():
+                    self.distribution[state] = \
+                        self.distribution.get(state, 0.0) + weight * mass
+        elif n == k or np.allclose(q, 1 / k):
+            self.kind = "uniform"
+            self.tables = subset_tables(items, n)
+            self.distribution = {
+                state: mass / comb(k, n)
+                for state, mass in self.tables[0][n].items()
+            }
+        elif k <= EXACT_OPTIONS:
+            self.kind = "subsets"
+            self.subsets = []
+            self.distribution = {}
+            for mask, probability in subset_probabilities(q, n).items():
+                chosen = [i for i in range(k) if mask >> i & 1]
+                union = {0: 1.0}
+                for i in chosen:
+                    union = convolve(union, items[i])
+                self.subsets.append((chosen, probability, union))
+                for state, mass in union.items():
+                    self.distribution[state] = \
+                        self.distribution.get(state, 0.0) + \
+                        probability * mass
+        else:
+            raise NotExact(
+                f"Weighted draw of {n} options among {k} options")
+
+    def draw(self, target, rng):
+        "(option, state) pairs of a draw whose union is the target"
+        match self.kind:
+            case "free":
+                if self.n == 0:
+                    return []
+                if self.n == len(self.items):
+                    return [(i, 0) for i in range(self.n)]
+                if self.n == 1:
+                    i = np.searchsorted(
+                        self.cdf, rng.random() * self.cdf[-1], "right")
+                    return [(min(int(i), len(self.cdf) - 1), 0)]
+                options = rng.choice(
+                    len(self.items), self.n, replace=False, p=self.q)
+                return [(i, 0) for i in sorted(options.tolist())]
+            case "single":
+                cdf = self.cdfs.get(target)
+                if cdf is None:
+                    cdf = self.cdfs[target] = np.cumsum([
+                        weight * item.get(target, 0.0)
+                        for weight, item in zip(self.q.tolist(), self.items)
+                    ])
+                i = np.searchsorted(cdf, rng.random() * cdf[-1], "right")
+                return [(min(int(i), len(cdf) - 1), target)]
+            case "uniform":
+                return draw_subset(
+                    self.items, self.tables, self.n, target, rng)
+            case "subsets":
+                chosen, _, _ = self.subsets[pick(rng, [
+                    probability * union.get(target, 0.0)
+                    for _, probability, union in self.subsets
+                ])]
+                items = [self.items[i] for i in chosen]
+                tables = subset_tables(items, len(items))
+                return [
+                    (chosen[i], state) for i, state in draw_subset(
+                        items, tables, len(items), target, rng)
+                ]
+
+
+class LeafDraw(Draw):
+    """
+    Draw of n tags of a list
+    Tags that can't output a constrained tag are only counted: with
+    options as likely, the tags covering an included tag are drawn
+    first, then the others fill the draw.
+    """
+
+    def __init__(self, q, n, covers):
+        k = len(covers)
+        self.covering = [i for i, cover in enumerate(covers) if cover]
+        self.others = [i for i, cover in enumerate(covers) if cover == 0]
+        relevant = [i for i, cover in enumerate(covers) if cover != 0]
+
+        if not relevant or n in (0, 1) or not (
+                n == k or np.allclose(q, 1 / k)):
+            super().__init__(q, n, [
+                NEUTRAL if cover == 0 else
+                {} if cover is None else {cover: 1.0}
+                for cover in covers
+            ])
+            return
+
+        # Tags as likely, from the tags covering an included tag
+        self.q = q
+        self.n = n
+        self.kind = "counted"
+        self.items = [{covers[i]: 1.0} for i in self.covering]
+        self.tables = subset_tables(self.items, n)
+        self.counts = [
+            {
+                state: mass * comb(len(self.others), n - j) / comb(k, n)
+                for state, mass in table.items()
+            }
+            for j, table in enumerate(self.tables[0])
+        ]
+        self.distribution = {}
+        for table in self.counts:
+            for state, mass in table.items():
+                self.distribution[state] = \
+                    self.distribution.get(state, 0.0) + mass
+
+    def draw(self, target, rng):
+        if self.kind != "counted":
+            return super().draw(target, rng)
+
+        j = pick(rng, [table.get(target, 0.0) for table in self.counts])
+        picked = [
+            self.covering[i] for i, _ in draw_subset(
+                self.items, self.tables, j, target, rng)
+        ]
+        others = rng.choice(len(self.others), self.n - j, replace=False)
+        picked.extend(self.others[i] for i in others.tolist())
+        return [(i, 0) for i in sorted(picked)]
+
+
+class Conditioner:
+    """
+    Sample the combinations of a space, conditioned on constraints
+    Every part of the space gets the distribution of the included tags
+    it outputs: {bit mask of the included tags: probability}, leaving
+    out the combinations outputting an excluded tag. Combinations are
+    then drawn from the top, each part drawing a combination given the
+    included tags it has to output.
+    Parts joining several pieces without a comma separator, or adding
+    a prefix or a suffix around them, are refused when they can output
+    a constrained tag: the tags of the pieces would not be kept apart.
+    """
+
+    def __init__(self, space, constraints):
+        if len(constraints.include) > MAX_INCLUDED_TAGS:
+            raise NotExact("Too many included tags")
+        self.space = space
+        self.constraints = constraints
+        self._parts = {}
+
+    def probability(self):
+        "Probability of a combination of the space to meet the constraints"
+        return self.distribution(self.space).get(self.constraints.full, 0.0)
+
+    def sample(self, rng):
+        "Draw a combination meeting the constraints"
+        return self.draw(self.space, self.constraints.full, rng)
+
+    def distribution(self, space):
+        return self.part(space)[0]
+
+    def part(self, space):
+        "(distribution, draws by number) of a space, computed once"
+        part = self._parts.get(id(space))
+        if part is None:
+            part = self._parts[id(space)] = (*self.compile(space), space)
+        return part[:2]
+
+    def compile(self, space):
+        if isinstance(space, OptionalSpace):
+            p = space.probability
+            if self.distribution(space.space) is NEUTRAL:
+                return NEUTRAL, None
+            distribution = {
+                state: p * mass
+                for state, mass in self.distribution(space.space).items()
+            }
+            distribution[0] = distribution.get(0, 0.0) + 1 - p
+            return distribution, None
+
+        if isinstance(space, LeafSpace):
+            covers = [
+                self.constraints.cover(space.text(i)) for i in space.options
+            ]
+            draws = {
+                n: LeafDraw(self.weights(space), n, covers)
+                for n in space.numbers
+            }
+            return self.mixture(space, draws, space.plan.separator)
+
+        if isinstance(space, GroupSpace):
+            items = [
+                self.distribution(space.children[i]) for i in space.options
+            ]
+            draws = {
+                n: Draw(self.weights(space), n, items)
+                for n in space.numbers
+            }
+            distribution, draws = self.mixture(
+                space, draws, space.plan.separator)
+            self.check_affixes(distribution, space.plan)
+            return distribution, draws
+
+        if isinstance(space, ProductSpace):
+            items = [self.distribution(child) for child in space.children]
+            draw = Draw(np.ones(len(items)) / max(len(items), 1),
+                        len(items), items)
+            if len(items) > 1:
+                self.check_separator(draw.distribution, space.separator)
+            self.check_affixes(draw.distribution, space)
+            return draw.distribution, {len(items): draw}
+
+        if type(space) is Space:
+            return NEUTRAL, None
+
+        raise NotExact("Unsupported space")
+
+    def weights(self, space):
+        p = space.plan.p[space.options]
+        return p / np.sum(p)
+
+    def mixture(self, space, draws, separator):
+        "Distribution of a part drawing a number of options, each as likely"
+        if all(draw.distribution is NEUTRAL for draw in draws.values()):
+            return NEUTRAL, draws
+
+        distribution = {}
+        for draw in draws.values():
+            for state, mass in draw.distribution.items():
+                distribution[state] = \
+                    distribution.get(state, 0.0) + mass / len(draws)
+
+        if max(draws) > 1:
+            self.check_separator(distribution, separator)
+        return distribution, draws
+
+    def check_separator(self, distribution, separator):
+        if distribution is not NEUTRAL and separator not in SEPARATORS:
+            raise NotExact("Constrained tags joined without a comma")
+
+    def check_affixes(self, distribution, part):
+        if distribution is not NEUTRAL and (part.prefix or part.suffix):
+            raise NotExact("Constrained tags with a prefix or a suffix")
+
+    def draw(self, space, target, rng):
+        "Combination of a space outputting the target included tags"
+        distribution, draws = self.part(space)
+
+        if isinstance(space, OptionalSpace):
+            inner = self.distribution(space.space).get(target, 0.0)
+            off = 1 - space.probability if target == 0 else 0.0
+            if pick(rng, [off, space.probability * inner]) == 0:
+                return None
+            return self.draw(space.space, target, rng)
+
+        if isinstance(space, LeafSpace):
+            n = self.number(draws, target, rng)
+            return tuple(
+                space.options[i] for i, _ in draws[n].draw(target, rng))
+
+        if isinstance(space, GroupSpace):
+            n = self.number(draws, target, rng)
+            return tuple(
+                (space.options[i],
+                 self.draw(space.children[space.options[i]], state, rng))
+                for i, state in draws[n].draw(target, rng)
+            )
+
+        if isinstance(space, ProductSpace):
+            (draw,) = draws.values()
+            states = dict(draw.draw(target, rng))
+            return tuple(
+                self.draw(child, states.get(i, 0), rng)
+                for i, child in enumerate(space.children)
+            )
+
+        return ()
+
+    def number(self, draws, target, rng):
+        "Number of options drawn, given the target"
+        numbers = list(draws)
+        return numbers[pick(rng, [
+            draws[n].distribution.get(target, 0.0) for n in numbers
+        ])]
+
+
+def conditioned_prompts(space, build_prompts, n, include=(), exclude=(),
+                        seed=0, max_attempts=None):
+    """
+    Return up to n prompts meeting the constraints, and a report
+    Prompts are drawn from the distribution of the prompts conditioned
+    on the constraints: they include every tag of include, and none of
+    exclude. Rows are {"prompt", "token", "seed"}:
+    - indexed spaces are conditioned exactly, and the token of a prompt
+      is its index: space.prompt(token) builds it again
+    - other prompts are built by seed from build_prompts(seeds), keeping
+      the ones meeting the constraints, until max_attempts seeds are
+      tried. The seed of a prompt builds it again.
+    The report tells the method used and why, the probability of the
+    constraints (estimated by the fallback) and the attempts made.
+    """
+    constraints = Constraints(include, exclude)
+
+    reason = "The prompts can't be indexed"
+    if space is not None:
+        try:
+            return exact_prompts(space, constraints, n, seed)
+        except NotExact as error:
+            reason = str(error)
+
+    return rejection_prompts(
+        build_prompts, constraints, n, seed, max_attempts, reason)
+
+
+def exact_prompts(space, constraints, n, seed):
+    conditioner = Conditioner(space, constraints)
+    probability = conditioner.probability()
+
+    rows = []
+    if probability > 0:
+        rng = np.random.default_rng(seed)
+        for _ in range(n):
+            choice = conditioner.sample(rng)
+            prompt = space.render(choice)
+            if not constraints.matches(prompt):
+                raise NotExact("A conditioned prompt misses the constraints")
+            rows.append({
+                "prompt": prompt, "token": space.rank(choice), "seed": None
+            })
+
+    return rows, {
+        "method": "exact",
+        "reason": None,
+        "probability": probability,
+        "attempts": len(rows),
+        "found": len(rows),
+    }
+
+
+def rejection_prompts(build_prompts, constraints, n, seed, max_attempts,
+                      reason):
+    "Build prompts by seed, in batches, keeping the ones meeting constraints"
+    if max_attempts is None:
+        max_attempts = MAX_ATTEMPTS
+
+    rows = []
+    tried = 0
+    while len(rows) < n and tried < max_attempts:
+        seeds = range(seed + tried,
+                      seed + tried + min(BATCH_SIZE, max_attempts - tried))
+        for s, prompt in zip(seeds, build_prompts(seeds)):
+            tried += 1
+            if constraints.matches(prompt):
+                rows.append({"prompt": prompt, "token": None, "seed": s})
+                if len(rows) >= n:
+                    break
+
+    return rows, {
+        "method": "rejection",
+        "reason": reason,
+        "probability": len(rows) / tried if tried else 0.0,
+        "attempts": tried,
+        "found": len(rows),
+    }
@@ -0,0 +1,159 @@
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+from ...utils.config import load_nodes_config, load_variables_config
+from ...utils.instrumentation import count
+from ._compiler import compile_config
+from ._rules import (
+    compile_rules,
+    new_rule_state,
+    current_rule_state,
+    rules_scope
+)
+from ._streams import Streams, streams_enabled
+from ._variables import process_variables
+
+# Hidden ComfyUI inputs telling which execution a node belongs to
+HIDDEN_INPUTS = {"prompt_graph": "PROMPT", "unique_id": "UNIQUE_ID"}
+
+# Executions whose nodes didn't all run (e.g. cached by ComfyUI) are
+# released once this many newer executions started
+MAX_CONTEXTS = 16
+
+# Nodes of a graph sharing the context, besides the generated ones
+SHARING_NODES = ("Composer", "Pipeline")
+
+
+class VariableContext:
+    """
+    Global variables shared by the nodes of an execution
+    They are resolved once per seed, with their own random stream, so
+    every node using that seed gets the same fixed variables.
+    Unfixed variables are kept as they are, to be sampled by each node.
+    The rules fired by a node patch the nodes running after it.
+    """
+
+    def __init__(self, graph, node_ids):
+        self.graph = graph
+        self.pending = set(node_ids)
+        self.config = None
+        self._variables = {}
+        self._rules = None
+        self._rule_state = None
+        self._lock = threading.Lock()
+
+    def variables(self, seed):
+        "Global variables resolved for a seed"
+        config = load_variables_config()
+        streams = streams_enabled()
+        with self._lock:
+            # The config changed during the execution
+            if config is not self.config:
+                self.config = config
+                self._variables.clear()
+
+            variables = self._variables.get((seed, streams))
+            if variables is None:
+                count("context.miss")
+                rng = np.random.default_rng((seed, 1))
+                select = compile_config(config).select
+                variables = process_variables(
+                    rng, config, select,
+                    Streams(seed, "globals") if streams else None)
+                self._variables[(seed, streams)] = variables
+            else:
+                count("context.hit")
+            return variables
+
+    def rule_state(self):
+        "Rules fired by the nodes of the execution, whatever their seed"
+        rules = compile_rules()
+        with self._lock:
+            # The rules or the nodes changed during the execution
+            if rules is not self._rules:
+                self._rules = rules
+                self._rule_state = new_rule_state(rules)
+            return self._rule_state
+
+    def done(self, unique_id):
+        "A node ran, return whether every node of the graph did"
+        with self._lock:
+            self.pending.discard(unique_id)
+            return not self.pending
+
+
+_contexts = OrderedDict()
+_contexts_lock = threading.Lock()
+
+
+def execution_context(graph, unique_id):
+    """
+    Return the context of the execution of a graph
+    ComfyUI gives the same graph object to every node of an execution.
+    """
+    if graph is None or unique_id is None:
+        return None
+
+    with _contexts_lock:
+        context = _contexts.get(id(graph))
+        if context is None or context.graph is not graph:
+            nodes = set(load_nodes_config()).union(SHARING_NODES)
+            context = VariableContext(graph, [
+                node_id for node_id, node in graph.items()
+                if isinstance(node, dict) and node.get("class_type") in nodes
+            ])
+            _contexts[id(graph)] = context
+            while len(_contexts) > MAX_CONTEXTS:
+                _contexts.popitem(last=False)
+        return context
+
+
+def release_context(context, unique_id):
+    "Drop the context once every node of its graph ran"
+    if context is None or not context.done(unique_id):
+        return
+    with _contexts_lock:
+        if _contexts.get(id(context.graph)) is context:
+            del _contexts[id(context.graph)]
+
+
+_scope = contextvars.ContextVar("variable_context", default=None)
+
+
+def current_context():
+    "Context of the execution being built, None outside of ComfyUI"
+    return _scope.get()
+
+
+def shared_variables(seed):
+    "Global variables of the current execution for a seed, or None"
+    context = _scope.get()
+    if context is None:
+        return None
+    return context.variables(seed)
+
+
+@contextmanager
+def execution_scope(args):
+    """
+    Share the variables and the fired rules of the execution the hidden
+    inputs belong to, or of the enclosing rules_scope() outside of it
+    The hidden inputs are removed from the args.
+    """
+    graph = args.pop("prompt_graph", None)
+    unique_id = args.pop("unique_id", None)
+    context = execution_context(graph, unique_id)
+    state = current_rule_state() if context is None \
+        else context.rule_state()
+
+    token = _scope.set(context)
+    try:
+        with rules_scope(state):
+            yield context
+    finally:
+        _scope.reset(token)
+        release_context(context, unique_id)
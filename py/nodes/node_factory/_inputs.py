@@ -55,6 +55,14 @@ def format_value(key, value):
 
         case dict():
 
+            # External vocabulary: a checkbox, or its probability
+            if "vocabulary" in value and "tags" not in value and \
+               not value.get("hide", False):
+                probability = value.get("probability", 1)
+                if probability != 1:
+                    return format_value(key, probability)
+                return format_value(key, True)
+
             conditions = [
                 value.get("hide", False),
                 "tags" not in value
@@ -98,12 +106,49 @@ def format_subtags(key, value):
     return input
 
 
+class InputOverlay:
+    """
+    What has been selected in the node inputs, over the shared config
+    Values are config groups or selected strings, and a probability set
+    in the inputs is kept aside instead of being written to the group.
+    The config is never copied nor modified, so an overlay is cheap to
+    build and executions of the same node can run concurrently.
+    """
+
+    __slots__ = ("values", "probabilities")
+
+    def __init__(self, values, probabilities):
+        self.values = values
+        self.probabilities = probabilities
+
+    def __iter__(self):
+        "Yield (key, value, probability or None) for each tag group"
+        probabilities = self.probabilities
+        for key, value in self.values.items():
+            yield key, value, probabilities.get(key)
+
+    def apply(self):
+        "Return the values, with the probabilities applied on copies"
+        applied_values = dict(self.values)
+        for key, probability in self.probabilities.items():
+            applied_values[key] = {
+                **applied_values[key], "probability": probability
+            }
+        return applied_values
+
+
 def apply_input_values(data, inputs):
     """
     Apply what has been selected in the node inputs
     Can be "random", "none", or a selected value
     """
+    return input_overlay(data, inputs).apply()
+
+
+def input_overlay(data, inputs):
+    "Return the InputOverlay of the node inputs"
     applied_values = {}
+    probabilities = {}
 
     # Remove "?" from keys in inputs
     inputs = {key.rstrip('?'): value for key, value in inputs.items()}
@@ -118,24 +163,31 @@ def apply_input_values(data, inputs):
                 # If "none" or false, just ignore the tag
                 case "none" | False:
                     applied_values[key] = ""
+                    probabilities.pop(key, None)
 
                 # If a number, use "probability"
+                # The config is shared, so it is kept in the overlay
                 case int() | float():
-                    if isinstance(value, dict) and "probability" in value:
-                        value["probability"] = selected
                     applied_values[key] = value
+                    if isinstance(value, dict) and "probability" in value:
+                        probabilities[key] = selected
+                    else:
+                        probabilities.pop(key, None)
 
                 # If "random", return the string, list or dict
                 # according to the JSON config file
                 case "random":
                     applied_values[key] = value
+                    probabilities.pop(key, None)
 
-                    if isinstance(value, dict) and not value.get("tags"):
+                    if isinstance(value, dict) and not value.get("tags") \
+                            and "vocabulary" not in value:
                         traverse(value)
 
                 # If a value is selected, just return it
                 case _:
                     applied_values[key] = selected
+                    probabilities.pop(key, None)
 
                     if selected is True:
                         applied_values[key] = value
@@ -150,4 +202,4 @@ def apply_input_values(data, inputs):
                             applied_values[key] = value["tags"][selected]
 
     traverse(data)
-    return applied_values
+    return InputOverlay(applied_values, probabilities)
@@ -0,0 +1,319 @@
+from collections import Counter
+
+import numpy as np
+
+from ...utils.config import load_variables_config, RESERVED_KEYS
+from ._compiler import (
+    compile_config, LeafPlan, GroupPlan, RecursivePlan, VocabularyPlan,
+    VocabularyChoice
+)
+from ._inputs import input_overlay
+from ._rules import compile_rules
+from ._variables import parse_template
+from ._vocabulary import load_vocabulary
+
+# Samples of the estimators, when a probability can't be computed
+SAMPLES = 20000
+
+# Draws without replacement among up to this many weighted tags are
+# computed exactly, by enumerating the subsets
+EXACT_OPTIONS = 12
+
+# Random keys drawn at once, and in total, by the vectorized estimator
+CHUNK_ELEMENTS = 1 << 22
+MAX_ELEMENTS = 1 << 27
+
+# Confidence intervals of the estimates: 95%
+Z = 1.96
+
+
+class Inexact(Exception):
+    "The probabilities of a node can't be computed from its config"
+
+
+def inclusion(p, numbers, rng, samples=SAMPLES):
+    """
+    Probability of each option to be picked, its standard error, and
+    whether it is exact
+    n options are drawn without replacement like rng.choice() does, n
+    being drawn uniformly among the numbers.
+    """
+    p = np.asarray(p, dtype=np.float64)
+    k = int(np.count_nonzero(p > 0))
+    probabilities = np.zeros(len(p))
+    variances = np.zeros(len(p))
+    exact = True
+
+    for n in numbers:
+        if n > k:
+            raise ValueError("Fewer non-zero entries in p than size")
+        picked = exact_inclusion(p, n, k)
+        if picked is None:
+            picked, variance = estimate_inclusion(p, n, k, rng, samples)
+            variances += variance
+            exact = False
+        probabilities += picked
+
+    count = len(numbers)
+    return probabilities / count, np.sqrt(variances) / count, exact
+
+
+def exact_inclusion(p, n, k):
+    "Exact probability of each option to be among n draws, or None"
+    q = p / np.sum(p)
+    nonzero = q > 0
+
+    if n == 0:
+        return np.zeros(len(q))
+    if n == 1:
+        return q
+    if n == k:
+        return nonzero.astype(np.float64)
+    if np.allclose(q[nonzero], 1 / k):
+        return nonzero * (n / k)
+    if n == 2:
+        # P(i first) + P(i second) = q_i + sum(q_j q_i / (1 - q_j), j != i)
+        ratios = np.where(nonzero, q / (1 - q), 0)
+        return q * (1 + np.sum(ratios) - ratios)
+    if k <= EXACT_OPTIONS:
+        return subset_inclusion(q, n)
+    return None
+
+
+def subset_inclusion(q, n):
+    "Inclusion probabilities, from the probabilities of the subsets"
+    options = np.flatnonzero(q > 0).tolist()
+    probabilities = np.zeros(len(q))
+    for mask, probability in subset_probabilities(q, n).items():
+        for bit, i in enumerate(options):
+            if mask >> bit & 1:
+                probabilities[i] += probability
+    return probabilities
+
+
+def subset_probabilities(q, n):
+    """
+    Probability of each subset of n options to be drawn, one draw after
+    the other: {bit mask of the non-zero options: probability}
+    """
+    options = np.flatnonzero(q > 0).tolist()
+    weights = q.tolist()
+
+    # Subset (bit mask of the options) -> (probability, weight drawn)
+    subsets = {0: (1.0, 0.0)}
+    for _ in range(n):
+        drawn = {}
+        for mask, (probability, weight) in subsets.items():
+            for bit, i in enumerate(options):
+                if mask >> bit & 1:
+                    continue
+                key = mask | 1 << bit
+                previous = drawn.get(key, (0.0, weight + weights[i]))[0]
+                drawn[key] = (
+                    previous + probability * weights[i] / (1 - weight),
+                    weight + weights[i]
+                )
+        subsets = drawn
+
+    return {mask: probability for mask, (probability, _) in subsets.items()}
+
+
+def estimate_inclusion(p, n, k, rng, samples):
+    """
+    Estimate the inclusion probabilities, and their variance
+    Drawing without replacement is the same as keeping the n largest
+    log(p) + Gumbel noise keys, so every sample is drawn at once.
+    """
+    options = np.flatnonzero(p > 0)
+    log_p = np.log(p[options])
+    samples = max(min(samples, MAX_ELEMENTS // k), 100)
+    rows = max(CHUNK_ELEMENTS // k, 1)
+
+    counts = np.zeros(k)
+    for start in range(0, samples, rows):
+        size = min(rows, samples - start)
+        keys = log_p + rng.gumbel(size=(size, k))
+        top = np.argpartition(keys, k - n, axis=1)[:, k - n:]
+        counts += np.bincount(top.ravel(), minlength=k)
+
+    probabilities = np.zeros(len(p))
+    variances = np.zeros(len(p))
+    probabilities[options] = counts / samples
+    variances[options] = counts / samples * (1 - counts / samples) / samples
+    return probabilities, variances
+
+
+def numbers(plan):
+    "Numbers of tags a plan can pick, each as likely"
+    number = plan.number
+    if isinstance(number, tuple):
+        if number[0] >= number[1]:
+            raise ValueError("Invalid number of tags")
+        return list(range(*number))
+    return [number]
+
+
+class TagReport:
+    """
+    Probability of each tag of a node to be picked, from its config
+    Probabilities are multiplied along the groups, as every group draws
+    its own random numbers. Tags using {variables} add the tags of the
+    variables, with the probability of the tag using them.
+    """
+
+    def __init__(self, data, variables, rng, samples=SAMPLES):
+        self.plans = compile_config(data)
+        self.variables = variables
+        self.rng = rng
+        self.samples = samples
+        self.rows = {}
+        self.rules = compile_rules()
+        self.targets = {
+            id(action.target)
+            for actions in self.rules.actions for action in actions
+        }
+        self.targeted = False
+
+    def add(self, path, tag, probability, error, exact):
+        row = self.rows.setdefault((path, tag), [0.0, 0.0, True])
+        row[0] += probability
+        row[1] = np.hypot(row[1], error)
+        row[2] = row[2] and exact
+
+    def walk(self, data, path, weight, error=0.0, exact=True, p=None,
+             resolving=frozenset()):
+        "Add the tags of a group, sampled with a probability of weight"
+        plan = self.plans.plan(data)
+        if id(plan.data) in self.targets:
+            self.targeted = True
+
+        if p is None:
+            p = getattr(plan, "probability", None)
+        if p is None:
+            raise Inexact(f"Unsupported group: {path}")
+        p = min(max(p, 0), 1)
+        weight, error = weight * p, error * p
+        if weight <= 0:
+            return
+
+        if isinstance(plan, VocabularyPlan):
+            plan = VocabularyChoice(plan.data, load_vocabulary(plan.name))
+            tag = plan.vocabulary.tag
+        elif isinstance(plan, LeafPlan):
+            tag = plan.tags.__getitem__
+        else:
+            tag = None
+
+        if tag is not None:
+            if plan.cdf is None:
+                raise ValueError(f"Invalid distribution: {path}")
+            picked, errors, picked_exact = inclusion(
+                plan.p, numbers(plan), self.rng, self.samples)
+            exact = exact and picked_exact
+            for i in np.flatnonzero(picked).tolist():
+                probability = weight * picked[i]
+                tag_error = np.hypot(error * picked[i], weight * errors[i])
+                text = tag(i)
+                if text:
+                    self.add(path, text, probability, tag_error, exact)
+                self.expand(f"{plan.prefix}{text}{plan.suffix}", path,
+                            probability, tag_error, exact, resolving)
+
+        elif isinstance(plan, GroupPlan):
+            if plan.cdf is None:
+                raise ValueError(f"Invalid distribution: {path}")
+            picked, errors, picked_exact = inclusion(
+                plan.p, numbers(plan), self.rng, self.samples)
+            exact = exact and picked_exact
+            for i, (label, child) in enumerate(
+                    zip(plan.labels, plan.children)):
+                if not picked[i]:
+                    continue
+                probability = weight * picked[i]
+                child_error = np.hypot(error * picked[i], weight * errors[i])
+                self.add(path, label, probability, child_error, exact)
+                self.expand(plan.prefix + plan.suffix, path,
+                            probability, child_error, exact, resolving)
+                self.walk(child.data, f"{path}/{label}", probability,
+                          child_error, exact, resolving=resolving)
+
+        elif isinstance(plan, RecursivePlan):
+            keys = [key for key in plan.data if key not in RESERVED_KEYS]
+            for key, child in zip(keys, plan.children):
+                self.expand(plan.prefix + plan.suffix, path,
+                            weight, error, exact, resolving)
+                self.walk(child.data, f"{path}/{key}", weight, error,
+                          exact, resolving=resolving)
+
+        else:
+            raise Inexact(f"Unsupported group: {path}")
+
+    def expand(self, text, path, weight, error, exact, resolving):
+        "Add the tags of the {variables} used in a text"
+        for name in parse_template(text)[1::2]:
+            if name in self.variables and name not in resolving:
+                self.walk(self.variables[name], f"{path}/{{{name}}}",
+                          weight, error, exact, resolving=resolving | {name})
+
+    def fires_rules(self):
+        "Whether a tag of the node triggers a rule patching the node"
+        return self.targeted and any(
+            tag in self.rules.index for _, tag in self.rows)
+
+
+def estimate_report(data, inputs, build, samples=SAMPLES, seed=0):
+    """
+    Estimate the probability of each tag by building prompts
+    build(rng, inputs, seed) builds the prompt of the node. Tags are
+    counted as they appear in the prompts, with their prefix and suffix,
+    once per prompt.
+    """
+    overlay = input_overlay(data["tags"], inputs)
+    counts = Counter()
+    for s in range(seed, seed + samples):
+        prompt = build(np.random.default_rng(s), overlay, s)
+        counts.update({tag.strip() for tag in prompt.split(",")} - {""})
+
+    rows = []
+    for tag, count in counts.items():
+        probability = count / samples
+        error = np.sqrt(probability * (1 - probability) / samples)
+        rows.append(report_row(None, tag, probability, error, False))
+    return sorted(rows, key=lambda row: -row["probability"])
+
+
+def tag_report(data, inputs, build, samples=SAMPLES, seed=0):
+    """
+    Return the probability of each tag of a node to be picked
+    Rows are {"path", "tag", "probability", "low", "high", "exact"},
+    low and high bounding estimated probabilities. A tag listed twice
+    in a group gets the sum of both probabilities. Nodes whose rules
+    patch their own groups, or groups the compiler doesn't handle, are
+    estimated by building prompts (see estimate_report).
+    """
+    variables = {**load_variables_config(), **data.get("variables", {})}
+    report = TagReport(data, variables, np.random.default_rng(seed), samples)
+
+    try:
+        for key, value, p in input_overlay(data["tags"], inputs):
+            report.walk(value, key, 1.0, p=p)
+        if report.fires_rules():
+            raise Inexact("Rules patching the node")
+    except Inexact:
+        return estimate_report(data, inputs, build, samples, seed)
+
+    return [
+        report_row(path, tag, probability, error, exact)
+        for (path, tag), (probability, error, exact) in report.rows.items()
+    ]
+
+
+def report_row(path, tag, probability, error, exact):
+    return {
+        "path": path,
+        "tag": tag,
+        "probability": float(probability),
+        "low": float(max(probability - Z * error, 0)),
+        "high": float(min(probability + Z * error, 1)),
+        "exact": exact,
+    }
@@ -0,0 +1,264 @@
+import os
+import json
+import time
+import atexit
+import sqlite3
+import logging
+import hashlib
+import threading
+from collections import OrderedDict
+
+from ...utils import config
+from ...utils.config import ROOT_PATH
+from ...utils.instrumentation import count
+from ._rules import current_rule_state, rules_scope
+from ._context import current_context
+from ._streams import streams_enabled
+
+logger = logging.getLogger(__name__)
+
+# Environment variable turning the result cache on:
+#   "memory"             keep the results in memory
+#   "disk"               also store them in .cache/results.sqlite3
+#   "disk:/path/to/file" also store them in the given file
+ENV_VARIABLE = "PROMPT_FACTORY_RESULT_CACHE"
+DEFAULT_DISK_FILE = os.path.join(ROOT_PATH, ".cache", "results.sqlite3")
+
+MAX_ENTRIES = 10000
+MAX_BYTES = 32 * 1024 * 1024
+MAX_DISK_ENTRIES = 1000000
+
+# Disk writes are committed together, every DISK_BATCH results or
+# DISK_INTERVAL seconds, and at exit
+DISK_BATCH = 256
+DISK_INTERVAL = 2.0
+
+# Bumped when the way results are built changes
+CACHE_VERSION = 4
+
+
+class ResultCache:
+    """
+    Bounded LRU cache of node results, with an optional disk store
+    The memory cache is limited in entries and in bytes. The disk store
+    keeps the results across restarts, dropping the oldest ones past
+    max_disk_entries. Its writes are queued and committed in batches,
+    so a cold cache doesn't pay a commit per result.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES,
+                 path=None, max_disk_entries=MAX_DISK_ENTRIES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._db = None
+        self._puts = 0
+        self._writes = {}
+        self._flushed_at = time.monotonic()
+        if path is not None:
+            atexit.register(self.flush)
+
+    def get(self, key):
+        "Return the cached value of a key, or None"
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                count("results.hit")
+                return entry[0]
+
+            value = self._disk_get(key)
+            if value is not None:
+                self._store(key, value)
+                self.hits += 1
+                self.disk_hits += 1
+                count("results.disk_hit")
+                return value
+
+            self.misses += 1
+            count("results.miss")
+            return None
+
+    def put(self, key, value):
+        "Cache the value of a key, value must be JSON serializable"
+        with self._lock:
+            self._store(key, value)
+            self._disk_put(key, value)
+
+    def stats(self):
+        "Return the hit ratio and the size of the cache"
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+    def flush(self):
+        "Commit the queued disk writes"
+        with self._lock:
+            self._disk_flush()
+
+    def clear(self):
+        "Empty the memory cache, the disk store is kept"
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _store(self, key, value):
+        size = len(key) + len(json.dumps(value)) + 64
+        if size > self.max_bytes:
+            return
+
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._bytes -= previous[1]
+        self._entries[key] = (value, size)
+        self._bytes += size
+
+        while len(self._entries) > self.max_entries or \
+                self._bytes > self.max_bytes:
+            _, (_, size) = self._entries.popitem(last=False)
+            self._bytes -= size
+
+    def _connect(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                        exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(key TEXT PRIMARY KEY, value TEXT)")
+        return self._db
+
+    def _disk_get(self, key):
+        if self.path is None:
+            return None
+        if key in self._writes:
+            return json.loads(self._writes[key])
+        try:
+            row = self._connect().execute(
+                "SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error:
+            return None
+        return None if row is None else json.loads(row[0])
+
+    def _disk_put(self, key, value):
+        if self.path is None:
+            return
+        self._writes[key] = json.dumps(value)
+        self._puts += 1
+        if len(self._writes) >= DISK_BATCH or \
+                time.monotonic() - self._flushed_at > DISK_INTERVAL:
+            self._disk_flush()
+
+    def _disk_flush(self):
+        self._flushed_at = time.monotonic()
+        if not self._writes:
+            return
+        writes, self._writes = self._writes, {}
+        try:
+            db = self._connect()
+            with db:
+                db.executemany(
+                    "INSERT OR REPLACE INTO results VALUES (?, ?)",
+                    writes.items())
+
+                # Drop the oldest results from time to time
+                if self._puts >= 1000:
+                    self._puts = 0
+                    db.execute(
+                        "DELETE FROM results WHERE rowid <= "
+                        "(SELECT MAX(rowid) FROM results) - ?",
+                        (self.max_disk_entries,))
+        except sqlite3.Error:
+            pass
+
+
+def result_key(kind, node_id, inputs, seed, fired=()):
+    """
+    Stable hash of everything a result depends on
+    The inputs are normalized: "?" suffixes removed and keys sorted.
+    Results built with the variables of an execution, or with the
+    group streams, are kept apart.
+    """
+    inputs = {
+        key.rstrip("?"): value for key, value in inputs.items()
+        if key != "seed"
+    }
+    key = json.dumps(
+        [CACHE_VERSION, kind, node_id, inputs, seed,
+         config.config_store.fingerprint(), list(fired),
+         current_context() is not None, streams_enabled()],
+        sort_keys=True, default=repr)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def cached_result(kind, node_id, inputs, seed, build):
+    """
+    Return the cached result of build(), or build and cache it
+    A result depends on the rules fired by the nodes built before it,
+    and fires rules for the nodes built after it: the rules fired by
+    build() are cached with the result and fired again on a hit.
+    """
+    cache = result_cache
+    if cache is None:
+        return build()
+
+    state = current_rule_state()
+    with rules_scope(state):
+        fired = tuple(state.fired) if state is not None else ()
+        key = result_key(kind, node_id, inputs, seed, fired)
+
+        entry = cache.get(key)
+        if entry is not None:
+            result, new_rules = entry
+            for rule_id in new_rules:
+                state.fire(rule_id)
+            return result
+
+        result = build()
+        new_rules = list(state.fired)[len(fired):] \
+            if state is not None else []
+        cache.put(key, [result, new_rules])
+        return result
+
+
+def cache_from_env(value=None):
+    "Create the result cache described by the environment variable"
+    if value is None:
+        value = os.environ.get(ENV_VARIABLE, "")
+    value = value.strip()
+
+    kind, _, path = value.partition(":")
+    match kind.lower():
+        case "" | "0" | "off" | "false":
+            return None
+        case "memory" | "1" | "on" | "true":
+            return ResultCache()
+        case "disk":
+            return ResultCache(path=path or DEFAULT_DISK_FILE)
+
+    # A cache setting never keeps the nodes from loading
+    logger.warning(
+        "Unknown %s value: %s, the result cache is disabled",
+        ENV_VARIABLE, value)
+    return None
+
+
+result_cache = cache_from_env()
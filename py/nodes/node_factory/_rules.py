@@ -0,0 +1,264 @@
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+import numpy as np
+
+from ...utils.config import load_nodes_config, load_rules_config
+from ._compiler import compile_tags, LeafPlan, GroupPlan
+
+logger = logging.getLogger(__name__)
+
+
+class Action:
+    "A compiled rule action on a target tag group"
+
+    __slots__ = ("id", "target", "remove_tags", "overwrite_tags")
+
+    def __init__(self, action_id, target, action):
+        self.id = action_id
+        self.target = target
+        self.remove_tags = frozenset(action.get("remove_tags", ()))
+        overwrite_tags = action.get("overwrite_tags")
+        self.overwrite_tags = None if overwrite_tags is None \
+            else list(overwrite_tags)
+
+
+class RuleSet:
+    """
+    Rules compiled into an inverted index: trigger tag -> rules
+    Picking a tag only looks up the rules it triggers.
+    """
+
+    def __init__(self, rules, nodes):
+        self.rules = rules
+        self.nodes = nodes
+        self.index = {}
+        self.actions = []
+        self.unresolved = []
+        self._patched = {}
+
+        action_id = 0
+        for rule_id, rule in enumerate(rules):
+            actions = []
+            for action in rule.get("actions", []):
+                target = resolve_target(nodes, action.get("target", ""))
+                if target is None:
+                    self.unresolved.append(action.get("target"))
+                    continue
+                actions.append(Action(action_id, target, action))
+                action_id += 1
+            self.actions.append(actions)
+
+            for trigger in rule.get("triggers", []):
+                self.index.setdefault(trigger, []).append(rule_id)
+
+        # Actions on a missing group would silently do nothing
+        if self.unresolved:
+            logger.warning(
+                "Rule targets not found in the nodes: %s",
+                ", ".join(map(str, self.unresolved)))
+
+    def patched_plan(self, actions):
+        """
+        Plan of a target group once the given actions are applied
+        Patched plans are cached, the compiled config is never modified.
+        """
+        key = tuple(action.id for action in actions)
+        plan = self._patched.get(key)
+        if plan is None:
+            if len(actions) == 1:
+                plan = compile_tags(actions[0].target)
+            else:
+                plan = self.patched_plan(actions[:-1])
+            plan = patch_plan(plan, actions[-1])
+            self._patched[key] = plan
+        return plan
+
+
+class RuleState:
+    """
+    Rules fired during an execution, and the groups they patched
+    It is used as a view on the compiled plans while sampling.
+    """
+
+    __slots__ = ("rules", "fired", "actions", "patches")
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.fired = {}
+        self.actions = {}
+        self.patches = {}
+
+    def resolve(self, plan):
+        "Return the patched plan of a group, if a rule targeted it"
+        if not self.patches:
+            return plan
+        return self.patches.get(id(plan.data), plan)
+
+    def picked(self, tag):
+        "Fire the rules triggered by a picked tag"
+        rule_ids = self.rules.index.get(tag)
+        if not rule_ids:
+            return
+
+        for rule_id in rule_ids:
+            if rule_id not in self.fired:
+                self.fire(rule_id)
+
+    def fire(self, rule_id):
+        "Apply the actions of a rule, the fired rules keep their order"
+        self.fired[rule_id] = None
+
+        for action in self.rules.actions[rule_id]:
+            key = id(action.target)
+            actions = (*self.actions.get(key, ()), action)
+            self.actions[key] = actions
+            self.patches[key] = self.rules.patched_plan(actions)
+
+
+def patch_plan(plan, action):
+    "Return a new plan with the action applied to the group"
+    data = plan.data
+    if not isinstance(data, dict):
+        data = {"tags": data}
+
+    if action.overwrite_tags is not None:
+        data = {
+            key: value for key, value in data.items()
+            if key != "distribution"
+        }
+        data["tags"] = action.overwrite_tags
+        return compile_tags(data)
+
+    if isinstance(plan, LeafPlan):
+        options = plan.tags
+    elif isinstance(plan, GroupPlan):
+        options = plan.labels
+    else:
+        return plan
+
+    data = dict(data)
+    kept = [
+        i for i, option in enumerate(options)
+        if option not in action.remove_tags
+    ]
+    if len(kept) == len(options):
+        return plan
+
+    # Renormalize the distribution of the remaining tags
+    p = plan.p[kept]
+    if np.sum(p) > 0:
+        data["distribution"] = (p / np.sum(p)).tolist()
+    else:
+        kept = []
+
+    if isinstance(plan, GroupPlan):
+        tags = list(data["tags"].items())
+        data["tags"] = {tags[i][0]: tags[i][1] for i in kept}
+    else:
+        data["tags"] = [options[i] for i in kept]
+
+    if not kept:
+        data = {"tags": [""]}
+
+    return compile_tags(data)
+
+
+def resolve_target(nodes, target):
+    """
+    Find the tag group of a target: "node/group/sub_group"
+    "tags" levels can be omitted. When a single group is given and
+    isn't at the root of the node, the first group with that name is used
+    """
+    node_id, _, path = target.partition("/")
+    if node_id not in nodes:
+        return None
+
+    keys = [key for key in path.split("/") if key and key != "tags"]
+    if not keys:
+        return None
+
+    data = nodes[node_id].get("tags", {})
+    for key in keys:
+        if isinstance(data, dict) and key not in data and \
+           isinstance(data.get("tags"), dict):
+            data = data["tags"]
+        if not isinstance(data, dict) or key not in data:
+            data = None
+            break
+        data = data[key]
+
+    if data is None and len(keys) == 1:
+        data = find_group(nodes[node_id].get("tags", {}), keys[0])
+
+    return data
+
+
+def find_group(data, key):
+    "First group named key, searching depth first"
+    if not isinstance(data, dict):
+        return None
+    if key in data:
+        return data[key]
+    for value in data.values():
+        found = find_group(value, key)
+        if found is not None:
+            return found
+    return None
+
+
+_compiled = None
+_compiled_lock = threading.Lock()
+
+
+def compile_rules():
+    "Return the rules compiled for the current config"
+    global _compiled
+    rules = load_rules_config()
+    nodes = load_nodes_config()
+
+    compiled = _compiled
+    if compiled is not None and compiled.rules is rules and \
+       compiled.nodes is nodes:
+        return compiled
+
+    with _compiled_lock:
+        if _compiled is None or _compiled.rules is not rules or \
+           _compiled.nodes is not nodes:
+            _compiled = RuleSet(rules, nodes)
+        return _compiled
+
+
+_scope = contextvars.ContextVar("rule_state", default=None)
+
+
+def new_rule_state(rules=None):
+    "Return a state for a new execution, or None without any rule"
+    if rules is None:
+        rules = compile_rules()
+    if not rules.index:
+        return None
+    return RuleState(rules)
+
+
+def current_rule_state():
+    "State shared by the current rules_scope(), or a new one"
+    state = _scope.get()
+    if state is None:
+        state = new_rule_state()
+    return state
+
+
+@contextmanager
+def rules_scope(state=None):
+    """
+    Share the fired rules between every node built inside the block
+    A rule triggered by a node patches the nodes built after it.
+    """
+    token = _scope.set(state or new_rule_state())
+    try:
+        yield _scope.get()
+    finally:
+        _scope.reset(token)
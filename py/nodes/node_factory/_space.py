@@ -0,0 +1,385 @@
+import random
+import hashlib
+from math import comb
+
+import numpy as np
+
+from ...utils.config import load_variables_config
+from ._compiler import (
+    compile_config, LeafPlan, GroupPlan, RecursivePlan, VocabularyPlan,
+    VocabularyChoice
+)
+from ._inputs import input_overlay
+from ._rules import compile_rules
+from ._tags import stringify_tags
+from ._variables import parse_template
+from ._vocabulary import load_vocabulary
+
+# Larger spaces are sampled by seed and deduplicated instead: collisions
+# are negligible there, and the prompts keep the config's distribution
+MAX_INDEXED_SIZE = 2 ** 64
+
+# Seeds tried per prompt requested, before giving up on a small space
+MAX_ATTEMPTS = 10
+
+
+class NotIndexable(Exception):
+    "The output of a group can't be enumerated"
+
+
+class Space:
+    """
+    Combinations a tag group can output, numbered from 0 to size - 1
+    unrank() returns the combination of an index (which tags or groups
+    are picked), rank() its index, and render() the string the group
+    outputs for it. Combinations are counted, not weighted: the
+    probabilities and distributions only tell which ones can happen.
+    """
+
+    size = 1
+
+    def prompt(self, index):
+        "Render the combination of an index"
+        if not 0 <= index < self.size:
+            raise IndexError(f"Index out of range: {index}")
+        return self.render(self.unrank(index))
+
+    def unrank(self, index):
+        return ()
+
+    def rank(self, choice):
+        return 0
+
+    def render(self, choice):
+        return ""
+
+
+class OptionalSpace(Space):
+    """
+    A group that may output nothing: index 0 is the empty combination
+    probability is the probability of the group to output something.
+    """
+
+    def __init__(self, space, probability=None):
+        self.space = space
+        self.probability = probability
+        self.size = space.size + 1
+
+    def unrank(self, index):
+        return None if index == 0 else self.space.unrank(index - 1)
+
+    def rank(self, choice):
+        return 0 if choice is None else self.space.rank(choice) + 1
+
+    def render(self, choice):
+        return "" if choice is None else self.space.render(choice)
+
+
+class LeafSpace(Space):
+    """
+    Subsets of a list of tags, by number of tags then in colex order
+    A combination is the sorted tuple of the indexes of the tags.
+    """
+
+    def __init__(self, plan, numbers, text, order=None):
+        self.plan = plan
+        self.options = np.flatnonzero(plan.p > 0).tolist()
+        self.positions = {i: position
+                          for position, i in enumerate(self.options)}
+        self.numbers = numbers
+        self.text = text
+        self.order = order
+
+        k = len(self.options)
+        if any(n > k for n in numbers):
+            raise NotIndexable("More tags to pick than tags")
+        self.blocks = [comb(k, n) for n in numbers]
+        self.size = sum(self.blocks)
+
+    def unrank(self, index):
+        for n, block in zip(self.numbers, self.blocks):
+            if index < block:
+                break
+            index -= block
+
+        # Combinatorial number system: largest c with comb(c, j) <= index
+        positions = []
+        high = len(self.options)
+        for j in range(n, 0, -1):
+            low = j - 1
+            while low < high - 1:
+                middle = (low + high) // 2
+                if comb(middle, j) <= index:
+                    low = middle
+                else:
+                    high = middle
+            positions.append(low)
+            index -= comb(low, j)
+            high = low
+
+        return tuple(self.options[position] for position in positions[::-1])
+
+    def rank(self, choice):
+        n = len(choice)
+        index = sum(self.blocks[:self.numbers.index(n)])
+        for j, i in enumerate(choice, 1):
+            index += comb(self.positions[i], j)
+        return index
+
+    def render(self, choice):
+        indexes = choice if self.order is None \
+            else sorted(choice, key=self.order.__getitem__)
+        return stringify_tags(
+            [self.text(i) for i in indexes], self.plan.separator)
+
+
+class GroupSpace(Space):
+    """
+    Sub-groups picked in a group, with the combination of each of them
+    A combination is a tuple of (sub-group index, combination) pairs.
+    Combinations are numbered by number of sub-groups, then with the
+    elementary symmetric sums of the sizes of the remaining sub-groups.
+    """
+
+    def __init__(self, plan, numbers, children):
+        self.plan = plan
+        self.numbers = numbers
+        self.options = np.flatnonzero(plan.p > 0).tolist()
+        self.children = children
+
+        # sums[i][j]: ways to pick j sub-groups among the options from i
+        k = len(self.options)
+        if any(n > k for n in numbers):
+            raise NotIndexable("More groups to pick than groups")
+        sizes = [children[i].size for i in self.options]
+        self.sums = [[1] + [0] * k for _ in range(k + 1)]
+        for i in range(k - 1, -1, -1):
+            for j in range(1, k - i + 1):
+                self.sums[i][j] = self.sums[i + 1][j] + \
+                    sizes[i] * self.sums[i + 1][j - 1]
+        self.blocks = [self.sums[0][n] for n in numbers]
+        self.size = sum(self.blocks)
+
+    def unrank(self, index):
+        for n, block in zip(self.numbers, self.blocks):
+            if index < block:
+                break
+            index -= block
+
+        choice = []
+        for position, i in enumerate(self.options):
+            if n == 0:
+                break
+            rest = self.sums[position + 1][n - 1]
+            picked = self.children[i].size * rest
+            if index < picked:
+                child_index, index = divmod(index, rest)
+                choice.append((i, self.children[i].unrank(child_index)))
+                n -= 1
+            else:
+                index -= picked
+        return tuple(choice)
+
+    def rank(self, choice):
+        n = len(choice)
+        index = sum(self.blocks[:self.numbers.index(n)])
+        picked = dict(choice)
+        for position, i in enumerate(self.options):
+            if n == 0:
+                break
+            rest = self.sums[position + 1][n - 1]
+            if i in picked:
+                index += self.children[i].rank(picked[i]) * rest
+                n -= 1
+            else:
+                index += self.children[i].size * rest
+        return index
+
+    def render(self, choice):
+        plan = self.plan
+        return stringify_tags([
+            f"{plan.prefix}{self.children[i].render(child)}{plan.suffix}"
+            for i, child in choice
+        ], plan.separator)
+
+
+class ProductSpace(Space):
+    """
+    Every sub-group outputs a combination, numbered in mixed radix
+    A combination is the tuple of the combinations of the sub-groups.
+    """
+
+    def __init__(self, children, prefix="", suffix="", separator=","):
+        self.children = children
+        self.prefix = prefix
+        self.suffix = suffix
+        self.separator = separator
+        self.size = 1
+        for child in children:
+            self.size *= child.size
+
+    def unrank(self, index):
+        choice = []
+        for child in reversed(self.children):
+            index, child_index = divmod(index, child.size)
+            choice.append(child.unrank(child_index))
+        return tuple(choice[::-1])
+
+    def rank(self, choice):
+        index = 0
+        for child, child_choice in zip(self.children, choice):
+            index = index * child.size + child.rank(child_choice)
+        return index
+
+    def render(self, choice):
+        return stringify_tags([
+            f"{self.prefix}{child.render(child_choice)}{self.suffix}"
+            for child, child_choice in zip(self.children, choice)
+        ], self.separator)
+
+
+class SpaceCompiler:
+    """
+    Build the space of compiled plans
+    Groups whose output can't be told from their config are refused:
+    fallback plans, groups targeted by rules (their tags depend on the
+    other picks), and tags using {variables}.
+    """
+
+    def __init__(self, plans, variables):
+        self.plans = plans
+        self.variables = variables
+        self.targets = {
+            id(action.target)
+            for actions in compile_rules().actions for action in actions
+        }
+
+    def space(self, data, p=None):
+        "Space of a group, given its probability when set in the inputs"
+        plan = self.plans.plan(data)
+        if id(plan.data) in self.targets:
+            raise NotIndexable("Group targeted by a rule")
+
+        space = self.compile(plan)
+        if p is None:
+            p = plan.probability
+        if p <= 0:
+            return Space()
+        return space if p >= 1 else OptionalSpace(space, p)
+
+    def compile(self, plan):
+        if isinstance(plan, VocabularyPlan):
+            vocabulary = load_vocabulary(plan.name)
+            if np.any(vocabulary.blob == ord("{")):
+                self.check_text(*map(vocabulary.tag, range(vocabulary.size)))
+            choice = VocabularyChoice(plan.data, vocabulary)
+            self.check_text(choice.prefix, choice.suffix, choice.separator)
+            return LeafSpace(
+                choice, self.numbers(choice),
+                lambda i: f"{choice.prefix}{vocabulary.tag(i)}{choice.suffix}")
+
+        if isinstance(plan, LeafPlan):
+            self.check_plan(plan)
+            self.check_text(*plan.tags)
+            return LeafSpace(
+                plan, self.numbers(plan), plan.affixed, plan.order)
+
+        if isinstance(plan, GroupPlan):
+            self.check_plan(plan)
+            return GroupSpace(plan, self.numbers(plan), [
+                self.space(child.data) for child in plan.children
+            ])
+
+        if isinstance(plan, RecursivePlan):
+            self.check_text(plan.prefix, plan.suffix, plan.separator)
+            return ProductSpace(
+                [self.space(child.data) for child in plan.children],
+                plan.prefix, plan.suffix, plan.separator)
+
+        raise NotIndexable("Group without a plan")
+
+    def check_plan(self, plan):
+        if plan.cdf is None:
+            raise NotIndexable("Invalid distribution")
+        self.check_text(plan.prefix, plan.suffix, plan.separator)
+
+    def numbers(self, plan):
+        "Numbers of tags the plan can pick"
+        number = plan.number
+        numbers = list(range(*number)) if isinstance(number, tuple) \
+            else [number]
+        if not numbers or numbers[0] < 0:
+            raise NotIndexable("Invalid number of tags")
+        return numbers
+
+    def check_text(self, *texts):
+        for text in texts:
+            names = parse_template(text)[1::2]
+            if any(name in self.variables for name in names):
+                raise NotIndexable("Tags using variables")
+
+
+def node_space(data, inputs):
+    """
+    Return the space of the prompts of a node, None if not indexable
+    The inputs are the node inputs, the seed is ignored.
+    """
+    plans = compile_config(data)
+    variables = {**load_variables_config(), **data.get("variables", {})}
+    compiler = SpaceCompiler(plans, variables)
+
+    try:
+        children = [
+            compiler.space(value, probability)
+            for _, value, probability in input_overlay(data["tags"], inputs)
+        ]
+    except NotIndexable:
+        return None
+    return ProductSpace(children, separator=", ")
+
+
+def permutation(size, seed):
+    "Yield the numbers below size in a random order, lazily"
+    rng = random.Random(seed)
+    swapped = {}
+    for i in range(size):
+        j = rng.randrange(i, size)
+        yield swapped.get(j, j)
+        swapped[j] = swapped.get(i, i)
+
+
+def unique_prompts(space, build_prompts, n, seed=0, max_attempts=None):
+    """
+    Return up to n distinct prompts
+    Indexed spaces are sampled without replacement, uniformly among the
+    combinations. Other spaces are sampled by seed from the given one,
+    skipping the prompts already seen, until n prompts are found or
+    max_attempts seeds are tried.
+    """
+    seen = set()
+    prompts = []
+
+    def add(prompt):
+        digest = hashlib.blake2b(prompt.encode(), digest_size=16).digest()
+        if digest not in seen:
+            seen.add(digest)
+            prompts.append(prompt)
+
+    if space is not None and space.size <= MAX_INDEXED_SIZE:
+        for index in permutation(space.size, seed):
+            if len(prompts) >= n:
+                break
+            add(space.prompt(index))
+        return prompts
+
+    if max_attempts is None:
+        max_attempts = n * MAX_ATTEMPTS
+    tried = 0
+    while len(prompts) < n and tried < max_attempts:
+        batch = min(max(n - len(prompts), 64), max_attempts - tried)
+        for prompt in build_prompts(range(seed + tried, seed + tried + batch)):
+            if len(prompts) >= n:
+                break
+            add(prompt)
+        tried += batch
+    return prompts
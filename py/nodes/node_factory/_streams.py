@@ -0,0 +1,124 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from functools import lru_cache
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Environment variable giving each tag group its own random stream:
+#   "1", "on", "true"    groups, variables and substitutions draw from
+#                        independent streams keyed by the seed and path
+# Prompts differ from the default sequential stream of the seed.
+ENV_VARIABLE = "PROMPT_FACTORY_RNG_STREAMS"
+
+SEED_MASK = (1 << 64) - 1
+
+# Config groups whose digest is kept, to key the cached groups
+MAX_DIGESTS = 4096
+
+
+class Streams:
+    """
+    Independent random streams of a seed, one per path
+    A stream is a Philox generator keyed by the seed and a hash of its
+    path: drawing from a stream never moves the others, and the stream
+    of any group of any seed starts without replaying earlier draws.
+    """
+
+    __slots__ = ("seed", "path")
+
+    def __init__(self, seed, *path):
+        self.seed = seed
+        self.path = path
+
+    def __call__(self, *path):
+        "Generator of a path, relative to the streams"
+        return stream(self.seed, *self.path, *path)
+
+    def child(self, *path):
+        "Streams of a sub-path"
+        return Streams(self.seed, *self.path, *path)
+
+
+_local = threading.local()
+
+
+def stream(seed, *path):
+    """
+    Generator of the stream of a seed and path
+    Creating a Philox generator is slow, so the generator of the thread
+    is rewound to the start of the stream instead: it is only valid
+    until the next stream is drawn in the thread.
+    """
+    generator = getattr(_local, "generator", None)
+    if generator is None:
+        generator = _local.generator = np.random.Generator(
+            np.random.Philox(key=0))
+        _local.state = generator.bit_generator.state
+
+    state = _local.state
+    state["state"]["counter"][:] = 0
+    state["state"]["key"][:] = (seed & SEED_MASK, path_key(path))
+    state["buffer_pos"] = 4
+    state["has_uint32"] = 0
+    generator.bit_generator.state = state
+    return generator
+
+
+@lru_cache(maxsize=8192)
+def path_key(path):
+    digest = hashlib.blake2b("\0".join(path).encode(), digest_size=8)
+    return int.from_bytes(digest.digest(), "little")
+
+
+_digests = {}
+
+
+def value_key(value):
+    """
+    Stable key of a selected value: the string itself, or a digest of a
+    config group, computed once per config snapshot
+    """
+    if isinstance(value, str):
+        return value
+
+    entry = _digests.get(id(value))
+    if entry is None or entry[0] is not value:
+        digest = hashlib.blake2b(
+            json.dumps(value, sort_keys=True, default=repr).encode(),
+            digest_size=16).hexdigest()
+        if len(_digests) >= MAX_DIGESTS:
+            _digests.clear()
+        entry = _digests[id(value)] = (value, digest)
+    return entry[1]
+
+
+def streams_enabled():
+    "Whether the groups draw from their own streams"
+    return group_streams
+
+
+def streams_from_env(value=None):
+    "Read the environment variable"
+    if value is None:
+        value = os.environ.get(ENV_VARIABLE, "")
+    value = value.strip().lower()
+
+    match value:
+        case "" | "0" | "off" | "false":
+            return False
+        case "1" | "on" | "true":
+            return True
+
+    # A mistyped setting never keeps the nodes from loading
+    logger.warning(
+        "Unknown %s value: %s, the group streams are disabled",
+        ENV_VARIABLE, value)
+    return False
+
+
+group_streams = streams_from_env()
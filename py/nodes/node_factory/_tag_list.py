@@ -0,0 +1,41 @@
+from collections import namedtuple
+
+from ._tags import stringify_tags
+
+# ComfyUI type of the structured output of the nodes
+TAG_LIST = "TAG_LIST"
+
+# A tag, the node it comes from, and the path of its tag group in that
+# node, e.g. "outfit/top"
+Tag = namedtuple("Tag", ["text", "node", "group"])
+
+
+class TagList(tuple):
+    """
+    Tags passed between nodes, with where they come from
+    Generated nodes give the tags their compiled plans rendered, and
+    nodes taking a tag list work on the tags directly instead of
+    splitting a prompt, so a tag is never split nor merged on the way.
+    Only strings, and groups changed by variables, are split.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_text(cls, text, node=None, group=None):
+        "Tags of a prompt, as they are split by CleanupPrompt"
+        return cls(Tag(tag, node, group) for tag in split_tags(text))
+
+    @classmethod
+    def from_pairs(cls, node, pairs):
+        "Tags of (text, group) pairs"
+        return cls(Tag(str(text), node, group) for text, group in pairs)
+
+    def text(self, separator=", "):
+        "The prompt of the tags"
+        return separator.join(tag.text for tag in self)
+
+
+def split_tags(text):
+    "Non-empty tags of a text"
+    return [tag for tag in stringify_tags([text], ", ").split(", ") if tag]
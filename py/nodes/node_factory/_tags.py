@@ -104,6 +104,14 @@ def stringify_tags(tags, separator=""):
     """
     if isinstance(tags, np.ndarray):
         tags = tags.tolist()
+
+    # Tags already clean are joined in a single pass
+    if separator in (",", ", "):
+        tags = list(tags)
+        rendered = render_tags(tags)
+        if rendered is not None:
+            return rendered
+
     tags = separator.join(map(str, tags))
 
     # Remove extra comma and spaces
@@ -111,3 +119,52 @@ def stringify_tags(tags, separator=""):
         ",,", ",").replace(",", ", ").strip(", ")
 
     return tags
+
+
+class CleanTags(str):
+    """
+    Tags stringify_tags() would leave as they are
+    Compiled plans mark the tags they render, so that joining them
+    doesn't need to clean them up again.
+    """
+
+    __slots__ = ()
+
+
+def is_clean(text):
+    """
+    Whether stringify_tags() leaves a text as it is: not empty, without
+    leading or trailing comma or space, and every comma followed by a
+    space then by something else than a comma
+    """
+    return bool(text) and text == text.strip(", ") and \
+        text.count(",") == text.count(", ") and ", ," not in text
+
+
+def render_tags(tags):
+    """
+    Join clean or empty tags in a single pass, None if a tag isn't
+    Same result as stringify_tags() with a "," or ", " separator: the
+    empty tags at the ends are dropped, and a run of k empty tags
+    between two tags leaves (k + 2) // 2 commas.
+    """
+    parts = []
+    empty = 0
+    clean = True
+    for tag in tags:
+        if tag.__class__ is CleanTags:
+            if parts:
+                if empty > 1:
+                    clean = False
+                parts.append(", " * ((empty + 2) // 2))
+            parts.append(tag)
+            empty = 0
+        elif tag == "":
+            empty += 1
+        else:
+            return None
+
+    if not parts:
+        return ""
+    rendered = "".join(parts)
+    return CleanTags(rendered) if clean else rendered
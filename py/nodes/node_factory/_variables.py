@@ -1,48 +1,141 @@
+import re
+import heapq
+from functools import lru_cache
+
 from ...utils.config import load_variables_config
 from ._tags import select_tags
 
+PLACEHOLDER = re.compile(r"\{([^{}]+)\}")
 
-def load_variables(rng, data):
-    "Load global and local variables from config files"
 
-    global_variables = load_variables_config()
+def load_variables(rng, data, select=select_tags, global_variables=None,
+                   streams=None):
+    """
+    Load global and local variables from config files
+    global_variables can be given already resolved, e.g. shared by the
+    nodes of an execution
+    With streams (see _streams.py), each variable draws from its own
+    stream instead of rng
+    """
+    if global_variables is None:
+        global_variables = load_variables_config()
 
     # Replace local variables with value from global variables
     local_variables = data.get("variables", {})
-    local_variables = process_variables(rng, local_variables)
-    local_variables = apply_variables(rng, local_variables, global_variables)
+    local_variables = process_variables(
+        rng, local_variables, select, streams and streams.child("local"))
+    local_variables = apply_variables(
+        rng, local_variables, global_variables, select,
+        streams and streams.child("local", "apply"))
 
     # Merge global and local variables
     variables = {**global_variables, **local_variables}
-    variables = process_variables(rng, variables)
+    variables = process_variables(
+        rng, variables, select, streams and streams.child("merged"))
     return variables
 
 
-def process_variables(rng, variables):
+def process_variables(rng, variables, select=select_tags, streams=None):
     "Process variable with list and dict"
+    variables = dict(variables)
     for key, value in variables.items():
         if isinstance(value, dict) and not value.get("fixed", True):
             continue
-        variables[key] = select_tags(rng, value)
+        if streams is not None:
+            rng = streams(key)
+        variables[key] = select(rng, value)
     return variables
 
 
-def apply_variables(rng, tags, variables):
-    "Replace tags with {variables} with corresponding variable"
+def apply_variables(rng, tags, variables, select=select_tags, streams=None):
+    """
+    Replace tags with {variables} with corresponding variable
+    With streams, the variables of each tag draw from the stream of its key
+    """
 
-    def replace_variables(text, variables):
-        for var_key, var_value in variables.items():
-            count = text.count("{" + var_key + "}")
-            for _ in range(count):
-                var_value = select_tags(rng, variables[var_key])
-                text = text.replace("{" + var_key + "}", f"{var_value}", 1)
-        return text
+    ranks = {key: rank for rank, key in enumerate(variables)}
 
     if isinstance(tags, str):
-        return [replace_variables(tags, variables)]
+        if streams is not None:
+            rng = streams()
+        return [substitute(rng, tags, variables, ranks, select)]
 
     replaced_tags = {}
     for key, value in tags.items():
-        replaced_tags[key] = replace_variables(value, variables)
+        # Streams are only created for the tags using variables
+        if streams is not None and len(parse_template(value)) > 1:
+            rng = streams(key)
+        replaced_tags[key] = substitute(rng, value, variables, ranks, select)
 
     return replaced_tags
+
+
+@lru_cache(maxsize=8192)
+def parse_template(text):
+    """
+    Split a text into literal parts and {variable} names
+    Names are at odd indexes: ("a ", "color", " b")
+    """
+    return tuple(PLACEHOLDER.split(text))
+
+
+def substitute(rng, text, variables, ranks=None, select=select_tags):
+    """
+    Replace the {variables} of a text in a single pass
+    Only the names found in the text are looked up, and each occurrence
+    is sampled again. Variables are resolved in the order of the
+    variables dict, so a seed gives the same text as the former
+    key-by-key replacement. A nested {variable} is resolved when its
+    turn comes, or right away if its turn has passed. A variable that
+    refers back to itself is left as it is.
+    """
+    parts = parse_template(text)
+    if len(parts) == 1:
+        return text
+
+    if ranks is None:
+        ranks = {key: rank for rank, key in enumerate(variables)}
+
+    # Tokens are literal strings, or (name,) tuples still to replace
+    pending = []
+
+    def tokenize(parts, rank, resolving):
+        "Tokens of parsed parts, resolving names whose turn has passed"
+        result = []
+        for i, part in enumerate(parts):
+            if i % 2 == 0:
+                result.append(part)
+                continue
+
+            name_rank = ranks.get(part)
+            if name_rank is None or part in resolving:
+                result.append("{" + part + "}")
+            elif name_rank > rank:
+                result.append((part,))
+                heapq.heappush(pending, (name_rank, part))
+            else:
+                value = f"{select(rng, variables[part])}"
+                result.extend(tokenize(
+                    parse_template(value), rank, resolving | {part}))
+        return result
+
+    tokens = tokenize(parts, -1, frozenset())
+
+    done = set()
+    while pending:
+        rank, name = heapq.heappop(pending)
+        if name in done:
+            continue
+        done.add(name)
+
+        replaced = []
+        for token in tokens:
+            if token.__class__ is tuple and token[0] == name:
+                value = f"{select(rng, variables[name])}"
+                replaced.extend(tokenize(
+                    parse_template(value), rank, frozenset((name,))))
+            else:
+                replaced.append(token)
+        tokens = replaced
+
+    return "".join(tokens)
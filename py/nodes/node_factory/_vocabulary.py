@@ -0,0 +1,162 @@
+import os
+import csv
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+
+import numpy as np
+
+from ...utils import config
+from ...utils.config import ROOT_PATH, file_stamp
+from ...utils.instrumentation import count
+
+CACHE_PATH = os.path.join(ROOT_PATH, ".cache", "vocabularies")
+
+# Bumped when the compiled layout changes
+VOCABULARY_VERSION = 1
+
+ARRAYS = ("offsets", "blob", "p", "cdf")
+
+
+class Vocabulary:
+    """
+    External list of tags, compiled into flat arrays
+    offsets and blob hold the UTF-8 tags, p and cdf their normalized
+    and cumulative weights. The arrays are memory-mapped from the
+    compiled files, so processes share them, and only the sampled tags
+    are decoded.
+    """
+
+    __slots__ = ("path", "stamp", "size", "nonzero") + ARRAYS
+
+    def __init__(self, path, stamp, arrays, nonzero):
+        self.path = path
+        self.stamp = stamp
+        self.offsets, self.blob, self.p, self.cdf = arrays
+        self.size = len(self.p)
+        self.nonzero = nonzero
+
+    def tag(self, i):
+        "Decode the tag at index i"
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.blob[start:end].tobytes().decode("utf-8")
+
+
+def read_vocabulary(path):
+    """
+    Read the tags and weights of a vocabulary file
+    .csv files have a tag,weight row per tag (the weight defaults to 1),
+    other files a tag per line. Empty lines are skipped.
+    """
+    tags = []
+    weights = []
+    with open(path, "r", encoding="utf-8", newline="") as file:
+        if path.lower().endswith(".csv"):
+            for row in csv.reader(file):
+                if not row or not row[0].strip():
+                    continue
+                tags.append(row[0].strip())
+                weights.append(float(row[1]) if len(row) > 1 else 1.0)
+        else:
+            for line in file:
+                tag = line.strip()
+                if tag:
+                    tags.append(tag)
+                    weights.append(1.0)
+    return tags, weights
+
+
+def compile_vocabulary(path):
+    "Return the arrays of a vocabulary file, and its number of tags drawable"
+    tags, weights = read_vocabulary(path)
+
+    encoded = [tag.encode("utf-8") for tag in tags]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(tag) for tag in encoded], out=offsets[1:])
+    blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+    p = np.array(weights, dtype=np.float64)
+    if len(p) and (np.any(p < 0) or not np.sum(p) > 0):
+        raise ValueError(f"Invalid weights in vocabulary {path}")
+    if len(p):
+        p /= np.sum(p)
+    cdf = np.cumsum(p)
+    if len(cdf):
+        cdf /= cdf[-1]
+
+    return (offsets, blob, p, cdf), int(np.count_nonzero(p > 0))
+
+
+def cache_folder(path, stamp):
+    key = f"{VOCABULARY_VERSION}{os.path.abspath(path)}{stamp}"
+    return os.path.join(CACHE_PATH, hashlib.sha1(key.encode()).hexdigest())
+
+
+def open_vocabulary(path, stamp):
+    """
+    Map the compiled arrays of a vocabulary, compiling it if needed
+    When the cache can't be written, the arrays are kept in memory.
+    """
+    folder = cache_folder(path, stamp)
+    try:
+        return map_vocabulary(path, stamp, folder)
+    except (OSError, ValueError):
+        pass
+
+    count("vocabulary.compile")
+    arrays, nonzero = compile_vocabulary(path)
+
+    try:
+        os.makedirs(CACHE_PATH, exist_ok=True)
+        temporary = tempfile.mkdtemp(dir=CACHE_PATH)
+        for name, array in zip(ARRAYS, arrays):
+            np.save(os.path.join(temporary, f"{name}.npy"), array)
+        with open(os.path.join(temporary, "meta.json"), "w") as file:
+            json.dump({"nonzero": nonzero}, file)
+        try:
+            os.replace(temporary, folder)
+        except OSError:
+            # Compiled by another process in the meantime
+            shutil.rmtree(temporary, ignore_errors=True)
+        return map_vocabulary(path, stamp, folder)
+    except (OSError, ValueError):
+        return Vocabulary(path, stamp, arrays, nonzero)
+
+
+def map_vocabulary(path, stamp, folder):
+    with open(os.path.join(folder, "meta.json"), "r") as file:
+        meta = json.load(file)
+    arrays = [
+        np.load(os.path.join(folder, f"{name}.npy"), mmap_mode="r")
+        for name in ARRAYS
+    ]
+    return Vocabulary(path, stamp, arrays, meta["nonzero"])
+
+
+_vocabularies = {}
+_lock = threading.Lock()
+
+
+def load_vocabulary(name):
+    """
+    Return the vocabulary of a config, reloaded when its file changes
+    The config store watches the files referenced by the config.
+    """
+    store = config.config_store
+    path = store.vocabulary_path(name)
+    stamp = store.vocabulary_stamp(path) or file_stamp(path)
+    if stamp is None:
+        raise FileNotFoundError(f"Vocabulary not found: {path}")
+
+    vocabulary = _vocabularies.get(path)
+    if vocabulary is not None and vocabulary.stamp == stamp:
+        return vocabulary
+
+    with _lock:
+        vocabulary = _vocabularies.get(path)
+        if vocabulary is None or vocabulary.stamp != stamp:
+            vocabulary = open_vocabulary(path, stamp)
+            _vocabularies[path] = vocabulary
+    return vocabulary
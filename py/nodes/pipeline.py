@@ -0,0 +1,137 @@
+from ..utils.config import load_nodes_config
+from ..utils.instrumentation import timed
+from .node_factory import NodeFactory
+from .node_factory._context import HIDDEN_INPUTS, execution_scope
+from .node_factory._rules import (
+    new_rule_state,
+    current_rule_state,
+    rules_scope
+)
+from .cleanup_prompt import CleanupPrompt
+from .composer import Composer
+
+# Node classes of the pipelines, created once per node id
+_node_classes = {}
+
+
+class Pipeline:
+    """
+    A ComfyUI node running a chain of nodes in one call
+    The generated nodes, merged in order by MergeStrings, then cleaned
+    up by CleanupPrompt, then composed by Composer, every node using the
+    same seed with its default inputs. The template is merged after the
+    nodes, the Composer only runs when there is one.
+    Inputs: node ids, merge, cleanup and Composer settings
+    Output: string
+    """
+
+    RETURN_TYPES = ("STRING",)
+    RETURN_NAMES = ("string",)
+    FUNCTION = "build_prompt"
+    CATEGORY = "⚙️ Prompt Factory/🛠️ Utils"
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "nodes": ("STRING", {
+                    "default": ", ".join(load_nodes_config())
+                }),
+                "separator": ("STRING", {"default": ", "}),
+                "cleanup": ("BOOLEAN", {"default": True}),
+                "sort": (
+                    ["none", "asc", "desc", "random"],
+                    {"default": "none"}
+                ),
+                "custom_sort": ("STRING", {"default": "", "multiline": True}),
+                "template": ("STRING", {"default": "", "multiline": True}),
+                "seed": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 0xffffffffffffffff
+                }),
+            },
+            "optional": {
+                "lazy": ("BOOLEAN", {"default": False}),
+            },
+            "hidden": dict(HIDDEN_INPUTS)
+        }
+
+    @timed("pipeline.build_prompt")
+    def build_prompt(self, **args):
+        """
+        Build the prompt of the chain for the seed
+        In ComfyUI, the nodes of an execution share the global variables
+        and the fired rules
+        """
+        with execution_scope(args):
+            seed = args.pop("seed")
+            prompts = self._build_prompts(
+                [seed], [current_rule_state()], **args)
+        return (prompts[0],)
+
+    @timed("pipeline.build_prompts")
+    def build_prompts(self, seeds, nodes=None, separator=", ", cleanup=True,
+                      sort="none", custom_sort="", template="", lazy=False):
+        """
+        Build the prompt of the chain once per seed
+        The nodes of a seed are built in order and share the rules they
+        fire, like in a rules_scope(). Cleanup runs once for every seed,
+        so custom_sort patterns are only compiled once. nodes is a list
+        of node ids, or a comma separated string of them, every node by
+        default.
+        """
+        seeds = list(seeds)
+        return self._build_prompts(
+            seeds, [new_rule_state() for _ in seeds], nodes, separator,
+            cleanup, sort, custom_sort, template, lazy)
+
+    def _build_prompts(self, seeds, states, nodes=None, separator=", ",
+                       cleanup=True, sort="none", custom_sort="",
+                       template="", lazy=False):
+        "Build the prompt of each seed, firing rules in its state"
+        nodes = [node_class(node_id)() for node_id in parse_node_ids(nodes)]
+
+        merged = []
+        for seed, state in zip(seeds, states):
+            with rules_scope(state):
+                prompts = [node.build_prompts([seed])[0] for node in nodes]
+            if template:
+                prompts.append(template)
+            merged.append(separator.join(prompts))
+        prompts = CleanupPrompt().cleanup_prompts(
+            merged, cleanup, sort, custom_sort, seeds)
+
+        if template:
+            composer = Composer()
+            for i, (seed, state) in enumerate(zip(seeds, states)):
+                with rules_scope(state):
+                    prompts[i] = composer.build_prompts(
+                        prompts[i], [seed], lazy)[0]
+        return prompts
+
+
+def parse_node_ids(nodes):
+    """
+    Node ids of a list, or of a comma separated string
+    None or a blank string give every node.
+    """
+    config = load_nodes_config()
+    if nodes is None or isinstance(nodes, str) and not nodes.strip():
+        return list(config)
+    if isinstance(nodes, str):
+        nodes = [node_id.strip() for node_id in nodes.split(",")]
+    node_ids = [node_id for node_id in nodes if node_id]
+
+    unknown = [node_id for node_id in node_ids if node_id not in config]
+    if unknown:
+        raise ValueError(f"Unknown nodes: {', '.join(unknown)}")
+    return node_ids
+
+
+def node_class(node_id):
+    "Class of a generated node"
+    cls = _node_classes.get(node_id)
+    if cls is None:
+        cls = _node_classes[node_id] = NodeFactory.create_node(node_id)
+    return cls
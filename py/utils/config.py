@@ -1,6 +1,12 @@
 import os
 import json
+import time
+import hashlib
+import threading
 from glob import glob
+from types import MappingProxyType
+
+from .instrumentation import timed, stage, count, gauge
 
 ROOT_PATH = os.path.abspath(os.path.join(
     os.path.dirname(__file__), '..', '..'))
@@ -8,6 +14,10 @@ ROOT_PATH = os.path.abspath(os.path.join(
 DEFAULT_PATH = "config.default"
 CUSTOM_PATH = "config"
 VARIABLE_FILE = "variables.json"
+RULES_FILE = "rules.json"
+
+# Minimum delay (in seconds) between two checks of the config files on disk
+CHECK_INTERVAL = 1.0
 
 RESERVED_KEYS = [
     "prefix",
@@ -18,35 +28,38 @@ RESERVED_KEYS = [
     "number",
     "hide",
     "group_labels",
-    "fixed"
+    "fixed",
+    "vocabulary"
 ]
 
 
+@timed("config.load_variables")
 def load_variables_config():
     "Load variables config file"
-    config_path = chose_config()
-    config_path = os.path.join(config_path, VARIABLE_FILE)
-    if not os.path.exists(config_path):
-        return {}
-    with open(config_path, 'r') as config_file:
-        config_data = json.load(config_file)
-    return config_data
+    return config_store.variables()
+
 
+@timed("config.load_rules")
+def load_rules_config():
+    "Load rules config file"
+    return config_store.rules()
 
+
+@timed("config.load_nodes")
 def load_nodes_config():
     "Load and merge all node's config files"
-    config_path = chose_config("nodes")
-    config_files = glob(os.path.join(
-        config_path, "**", "*.json"), recursive=True)
+    return config_store.nodes()
+
+
+@timed("config.load_node")
+def load_node_config(node_id):
+    "Load the config of a single node"
+    return config_store.node(node_id)
 
-    config = {}
-    for path in config_files:
-        with open(path, 'r') as config_file:
-            config_data = json.load(config_file)
-            node_id = os.path.splitext(os.path.basename(path))[0]
-            config[node_id] = config_data
 
-    return config
+def reload_config():
+    "Force a reload of the config files that changed on disk"
+    config_store.refresh(force=True)
 
 
 def chose_config(extra_path=""):
@@ -61,3 +74,197 @@ def chose_config(extra_path=""):
     absolute_config_path = os.path.join(ROOT_PATH, config_path, extra_path)
 
     return absolute_config_path
+
+
+class ConfigStore:
+    """
+    Process-wide cache of the config files
+    Each file is parsed once, then only reloaded when its mtime or size
+    changes. Readers get read-only snapshots: a reload builds a new snapshot
+    and never mutates one that was already served, so the parsed data must
+    be treated as read-only as well.
+    """
+
+    def __init__(self, resolve_path=chose_config,
+                 check_interval=CHECK_INTERVAL):
+        self.resolve_path = resolve_path
+        self.check_interval = check_interval
+        self.version = 0
+
+        self._lock = threading.Lock()
+        self._files = {}
+        self._nodes = MappingProxyType({})
+        self._variables = MappingProxyType({})
+        self._rules = ()
+        self._vocabularies = {}
+        self._fingerprint = None
+        self._checked_at = None
+
+    def nodes(self):
+        "Return a read-only mapping of every node config by node id"
+        self.refresh()
+        return self._nodes
+
+    def node(self, node_id):
+        "Return the config of a single node"
+        return self.nodes()[node_id]
+
+    def variables(self):
+        "Return a read-only mapping of the global variables"
+        self.refresh()
+        return self._variables
+
+    def rules(self):
+        "Return a read-only sequence of the rules"
+        self.refresh()
+        return self._rules
+
+    def fingerprint(self):
+        "Return a hash of the content of the config files"
+        self.refresh()
+        return self._fingerprint
+
+    def refresh(self, force=False):
+        "Reload the files that changed since the last check"
+        if not force and not self._is_stale():
+            return
+
+        with self._lock, stage("config.refresh"):
+            if not force and not self._is_stale():
+                return
+
+            files = {}
+            changed = False
+
+            node_paths, variables_path, rules_path = self.paths()
+
+            for path in [*node_paths, variables_path, rules_path]:
+                entry = self._load_file(path)
+                if entry is None:
+                    continue
+                files[path] = entry
+                changed |= entry is not self._files.get(path)
+
+            changed |= files.keys() != self._files.keys()
+
+            # External vocabularies referenced by the config
+            if changed:
+                vocabulary_paths = set()
+                for entry in files.values():
+                    find_vocabularies(entry[1], vocabulary_paths)
+                vocabulary_paths = [
+                    self.vocabulary_path(name) for name in vocabulary_paths
+                ]
+            else:
+                vocabulary_paths = self._vocabularies.keys()
+
+            vocabularies = {
+                path: file_stamp(path) for path in vocabulary_paths
+            }
+            changed |= vocabularies != self._vocabularies
+
+            if changed:
+                nodes = {}
+                for path in node_paths:
+                    if path in files:
+                        node_id = os.path.splitext(os.path.basename(path))[0]
+                        nodes[node_id] = files[path][1]
+
+                variables = files.get(variables_path, (None, {}))[1]
+                rules = files.get(rules_path, (None, []))[1]
+
+                self._files = files
+                self._nodes = MappingProxyType(nodes)
+                self._variables = MappingProxyType(variables)
+                self._rules = tuple(rules)
+                self._vocabularies = vocabularies
+                self._fingerprint = self._hash(files, vocabularies)
+                self.version += 1
+
+                count("config.reload")
+                gauge("config.nodes", len(nodes))
+                gauge("config.variables", len(variables))
+                gauge("config.rules", len(rules))
+                gauge("config.bytes", sum(
+                    entry[0][1] for entry in files.values()))
+
+            self._checked_at = time.monotonic()
+
+    def paths(self):
+        "Return the node config files, the variables and rules files"
+        nodes_path = self.resolve_path("nodes")
+        node_paths = glob(os.path.join(
+            nodes_path, "**", "*.json"), recursive=True)
+        variables_path = os.path.join(self.resolve_path(), VARIABLE_FILE)
+        rules_path = os.path.join(self.resolve_path(), RULES_FILE)
+        return node_paths, variables_path, rules_path
+
+    def vocabulary_path(self, name):
+        "Path of an external vocabulary, relative to the config folder"
+        return os.path.join(self.resolve_path(), name)
+
+    def vocabulary_stamp(self, path):
+        "(mtime, size) of a vocabulary, as of the last refresh"
+        self.refresh()
+        return self._vocabularies.get(path)
+
+    def _hash(self, files, vocabularies):
+        root = self.resolve_path()
+        digest = hashlib.sha1()
+        for path in sorted(files):
+            digest.update(os.path.relpath(path, root).encode())
+            digest.update(files[path][2])
+        for path in sorted(vocabularies):
+            digest.update(f"{path}{vocabularies[path]}".encode())
+        return digest.hexdigest()
+
+    def _is_stale(self):
+        if self._checked_at is None:
+            return True
+        return time.monotonic() - self._checked_at >= self.check_interval
+
+    def _load_file(self, path):
+        """
+        Return the cached (stamp, data, digest) entry of a file
+        The file is only read and parsed when it changed
+        """
+        stamp = file_stamp(path)
+        if stamp is None:
+            return None
+
+        entry = self._files.get(path)
+        if entry is not None and entry[0] == stamp:
+            count("config.file_cached")
+            return entry
+
+        count("config.file_parsed")
+        with open(path, 'rb') as config_file:
+            content = config_file.read()
+        config_data = json.loads(content)
+        return (stamp, config_data, hashlib.sha1(content).digest())
+
+
+def file_stamp(path):
+    "(mtime, size) of a file, None if it doesn't exist"
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def find_vocabularies(data, found):
+    "Add the vocabularies referenced in a config tree to found"
+    if isinstance(data, dict):
+        vocabulary = data.get("vocabulary")
+        if isinstance(vocabulary, str):
+            found.add(vocabulary)
+        for value in data.values():
+            find_vocabularies(value, found)
+    elif isinstance(data, list):
+        for value in data:
+            if not isinstance(value, str):
+                find_vocabularies(value, found)
+
+
+config_store = ConfigStore()
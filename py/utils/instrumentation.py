@@ -0,0 +1,210 @@
+import os
+import json
+import time
+import logging
+import atexit
+import threading
+
+# Environment variable turning the instrumentation on:
+#   "memory" (or "1")      aggregate in memory, see get_sink().summary()
+#   "jsonl"                write events to prompt_factory_metrics.jsonl
+#   "jsonl:/path/to/file"  write events to the given file
+ENV_VARIABLE = "PROMPT_FACTORY_INSTRUMENTATION"
+DEFAULT_JSONL_FILE = "prompt_factory_metrics.jsonl"
+
+logger = logging.getLogger(__name__)
+
+_sink = None
+
+
+class MemorySink:
+    """
+    Aggregate events in memory
+    Stages get a call count and total/min/max wall time, counters are
+    summed, and gauges keep their last value.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def record(self, event):
+        name = event["name"]
+        with self._lock:
+            match event["type"]:
+                case "stage":
+                    duration = event["duration"]
+                    stage = self.stages.get(name)
+                    if stage is None:
+                        self.stages[name] = {
+                            "calls": 1, "total": duration,
+                            "min": duration, "max": duration
+                        }
+                    else:
+                        stage["calls"] += 1
+                        stage["total"] += duration
+                        stage["min"] = min(stage["min"], duration)
+                        stage["max"] = max(stage["max"], duration)
+                case "count":
+                    self.counters[name] = \
+                        self.counters.get(name, 0) + event["value"]
+                case "gauge":
+                    self.gauges[name] = event["value"]
+
+    def summary(self):
+        "Return a copy of the aggregated stages, counters and gauges"
+        with self._lock:
+            return {
+                "stages": {
+                    name: {**stage, "mean": stage["total"] / stage["calls"]}
+                    for name, stage in self.stages.items()
+                },
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+            }
+
+    def reset(self):
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+
+
+class JsonlSink:
+    "Write each event as a JSON line, with its time and process id"
+
+    def __init__(self, path=DEFAULT_JSONL_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+        atexit.register(self.close)
+
+    def record(self, event):
+        line = json.dumps({"time": time.time(), "pid": os.getpid(), **event})
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(line + "\n")
+
+    def flush(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class _NullStage:
+    "Stage used while the instrumentation is disabled"
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.start
+        sink = _sink
+        if sink is not None:
+            sink.record({
+                "type": "stage", "name": self.name, "duration": duration
+            })
+        return False
+
+
+def stage(name):
+    "Context manager timing a stage, a no-op while disabled"
+    if _sink is None:
+        return _NULL_STAGE
+    return _Stage(name)
+
+
+def timed(name):
+    "Decorator timing every call of a function as a stage"
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            if _sink is None:
+                return function(*args, **kwargs)
+            with _Stage(name):
+                return function(*args, **kwargs)
+        wrapper.__name__ = function.__name__
+        wrapper.__qualname__ = function.__qualname__
+        wrapper.__doc__ = function.__doc__
+        wrapper.__wrapped__ = function
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    "Increment a counter (e.g. cache hits and misses)"
+    sink = _sink
+    if sink is not None:
+        sink.record({"type": "count", "name": name, "value": value})
+
+
+def gauge(name, value):
+    "Record the current value of a measure (e.g. a config size)"
+    sink = _sink
+    if sink is not None:
+        sink.record({"type": "gauge", "name": name, "value": value})
+
+
+def enabled():
+    return _sink is not None
+
+
+def get_sink():
+    return _sink
+
+
+def set_sink(sink):
+    """
+    Send the events to a sink, any object with a record(event) method
+    None disables the instrumentation. Return the previous sink.
+    """
+    global _sink
+    previous = _sink
+    _sink = sink
+    return previous
+
+
+def sink_from_env(value=None):
+    "Create the sink described by the environment variable"
+    if value is None:
+        value = os.environ.get(ENV_VARIABLE, "")
+    value = value.strip()
+
+    kind, _, path = value.partition(":")
+    match kind.lower():
+        case "" | "0" | "off" | "false":
+            return None
+        case "memory" | "1" | "on" | "true":
+            return MemorySink()
+        case "jsonl":
+            return JsonlSink(path or DEFAULT_JSONL_FILE)
+
+    # A diagnostics setting never keeps the nodes from loading
+    logger.warning(
+        "Unknown %s value: %s, instrumentation is disabled",
+        ENV_VARIABLE, value)
+    return None
+
+
+set_sink(sink_from_env())
@@ -0,0 +1,97 @@
+import os
+import json
+import hashlib
+from glob import glob
+
+from . import config
+from .config import ROOT_PATH
+
+MANIFEST_FILE = os.path.join(ROOT_PATH, ".cache", "nodes_manifest.json")
+
+# Bumped when the manifest layout changes
+MANIFEST_VERSION = 1
+
+# Class attributes ComfyUI reads without executing a node
+NODE_ATTRIBUTES = [
+    "RETURN_TYPES",
+    "RETURN_NAMES",
+    "FUNCTION",
+    "CATEGORY",
+    "OUTPUT_NODE",
+    "INPUT_IS_LIST",
+    "OUTPUT_IS_LIST",
+    "DESCRIPTION",
+]
+
+
+def config_hash():
+    """
+    Hash of the config files and of the package sources
+    The files are hashed as bytes, without parsing them.
+    """
+    node_paths, variables_path, rules_path = config.config_store.paths()
+    sources = glob(os.path.join(ROOT_PATH, "py", "**", "*.py"),
+                   recursive=True)
+
+    digest = hashlib.sha1(f"{MANIFEST_VERSION}".encode())
+    for path in [*sorted(node_paths), variables_path, rules_path,
+                 *sorted(sources)]:
+        digest.update(os.path.relpath(path, ROOT_PATH).encode())
+        try:
+            with open(path, "rb") as file:
+                digest.update(file.read())
+        except FileNotFoundError:
+            digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def load_manifest(path=MANIFEST_FILE, digest=None):
+    "Return the nodes of the manifest, or None if it is missing or stale"
+    try:
+        with open(path, "r") as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    if manifest.get("hash") != (digest or config_hash()):
+        return None
+    return manifest["nodes"]
+
+
+def write_manifest(nodes, path=MANIFEST_FILE, digest=None):
+    """
+    Save the registration of nodes to the manifest
+    nodes are (node_id, display_name, module, class_name, node_class)
+    where module and class_name tell where to find the node class,
+    relative to py.nodes. Node classes generated by the factory have a
+    class_name of None. Failing to write the cache is not an error.
+    """
+    manifest = {
+        "hash": digest or config_hash(),
+        "nodes": [
+            {
+                "id": node_id,
+                "name": name,
+                "module": module,
+                "class": class_name,
+                "attributes": {
+                    key: getattr(node_class, key)
+                    for key in NODE_ATTRIBUTES if hasattr(node_class, key)
+                },
+                "inputs": node_class.INPUT_TYPES(),
+            }
+            for node_id, name, module, class_name, node_class in nodes
+        ]
+    }
+
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(temporary_path, "w") as file:
+            json.dump(manifest, file)
+        os.replace(temporary_path, path)
+    except (OSError, TypeError, ValueError):
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        return False
+    return True
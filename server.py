@@ -0,0 +1,491 @@
+import time
+import json
+import asyncio
+import signal
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from py.utils.config import load_nodes_config
+
+# Requests for the same node and inputs arriving within this delay (in
+# seconds) are generated in a single batch
+BATCH_WINDOW = 0.002
+MAX_BATCH = 256
+
+# Latencies kept for the stats
+MAX_LATENCIES = 10000
+
+MAX_BODY = 1 << 20
+
+MAX_SEED = 0xffffffffffffffff
+
+REASONS = {
+    200: "OK", 400: "Bad Request", 404: "Not Found",
+    405: "Method Not Allowed", 413: "Payload Too Large",
+    500: "Internal Server Error"
+}
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+_workers = {}
+
+
+def run_batch(kind, target, inputs, items):
+    """
+    Generate the results of a batch, in a worker
+    items are seeds, or (prompt, seed) pairs to clean up.
+    Nodes are only created once per worker.
+    """
+    node = _workers.get((kind, target))
+    if node is None:
+        match kind:
+            case "node":
+                from py.nodes.node_factory import NodeFactory
+                node = NodeFactory.create_node(target)()
+            case "composer":
+                from py.nodes.composer import Composer
+                node = Composer()
+            case "cleanup":
+                from py.nodes.cleanup_prompt import CleanupPrompt
+                node = CleanupPrompt()
+            case "pipeline":
+                from py.nodes.pipeline import Pipeline
+                node = Pipeline()
+        _workers[(kind, target)] = node
+
+    match kind:
+        case "node":
+            return node.build_prompts(items, **inputs)
+        case "composer":
+            return node.build_prompts(seeds=items, **inputs)
+        case "cleanup":
+            prompts = [prompt for prompt, _ in items]
+            seeds = [seed for _, seed in items]
+            return node.cleanup_prompts(prompts, seeds=seeds, **inputs)
+        case "pipeline":
+            return node.build_prompts(items, **inputs)
+
+
+class Coalescer:
+    """
+    Group concurrent requests into batches
+    Requests with the same node and inputs only differ by their seed (or
+    by the prompt to clean up), so they are generated by a single call
+    in the pool.
+    """
+
+    def __init__(self, executor, window=BATCH_WINDOW, max_batch=MAX_BATCH):
+        self.executor = executor
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.batched = 0
+        self._pending = {}
+
+    async def submit(self, kind, target, inputs, item):
+        loop = asyncio.get_running_loop()
+        key = (kind, target, json.dumps(inputs, sort_keys=True))
+        future = loop.create_future()
+
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = []
+            loop.call_later(self.window, self._flush, key)
+        pending.append((item, future))
+
+        if len(pending) >= self.max_batch:
+            self._flush(key)
+
+        return await future
+
+    def _flush(self, key):
+        pending = self._pending.pop(key, None)
+        if not pending:
+            return
+
+        self.batches += 1
+        self.batched += len(pending)
+        self._run(key, pending)
+
+    def _run(self, key, pending):
+        kind, target, inputs = key
+        items = [item for item, _ in pending]
+
+        loop = asyncio.get_running_loop()
+        task = loop.run_in_executor(
+            self.executor, run_batch, kind, target, json.loads(inputs), items)
+        task.add_done_callback(lambda task: self._resolve(task, key, pending))
+
+    def _resolve(self, task, key, pending):
+        error = task.exception()
+
+        # Build the items of a failed batch one by one, so that a bad
+        # item only fails its own request
+        if error is not None and len(pending) > 1:
+            for entry in pending:
+                self._run(key, [entry])
+            return
+
+        for i, (_, future) in enumerate(pending):
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(task.result()[i])
+
+
+class Stats:
+    "Request counts, throughput and latencies per endpoint"
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.requests = {}
+        self.errors = 0
+        self.latencies = {}
+
+    def record(self, endpoint, latency):
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+        self.latencies.setdefault(
+            endpoint, deque(maxlen=MAX_LATENCIES)).append(latency)
+
+    def report(self, coalescer):
+        uptime = time.monotonic() - self.started_at
+        total = sum(self.requests.values())
+        return {
+            "uptime": uptime,
+            "requests": total,
+            "errors": self.errors,
+            "requests_per_sec": total / uptime if uptime else 0.0,
+            "batches": coalescer.batches,
+            "mean_batch_size":
+                coalescer.batched / coalescer.batches
+                if coalescer.batches else 0.0,
+            "endpoints": {
+                endpoint: {
+                    "requests": self.requests[endpoint],
+                    **percentiles(self.latencies[endpoint])
+                }
+                for endpoint in self.requests
+            }
+        }
+
+
+def percentiles(latencies):
+    "p50/p90/p99 latencies in milliseconds"
+    values = sorted(latencies)
+    return {
+        f"p{q}_ms": values[min(len(values) - 1, len(values) * q // 100)] * 1000
+        for q in (50, 90, 99)
+    }
+
+
+class Server:
+    """
+    Local HTTP server generating prompts
+    GET  /nodes                 ids of the generated nodes
+    POST /nodes/<id>            {"seed": 0, ...inputs} -> {"prompt": ...}
+    POST /composer              {"prompt": "...", "seed": 0, "lazy": false}
+    POST /cleanup               {"prompt": "...", "seed": 0, "sort": ...}
+    POST /pipeline              {"nodes": ["id", ...], "seed": 0, ...}
+    GET  /stats                 throughput and latencies
+    A "seeds" list can be sent instead of "seed", to get "prompts".
+    """
+
+    def __init__(self, executor):
+        self.coalescer = Coalescer(executor)
+        self.stats = Stats()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except HTTPError as error:
+                    # The rest of the stream can't be read as requests
+                    self.stats.errors += 1
+                    write_response(writer, error.status,
+                                   {"error": str(error)}, keep_alive=False)
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+
+                start = time.perf_counter()
+                try:
+                    status, response = 200, await self.route(
+                        method, path, body)
+                except HTTPError as error:
+                    status, response = error.status, {"error": str(error)}
+                except Exception as error:
+                    status, response = 500, {"error": repr(error)}
+
+                if status == 200:
+                    self.stats.record(
+                        path.split("?")[0], time.perf_counter() - start)
+                else:
+                    self.stats.errors += 1
+
+                keep_alive = headers.get("connection", "").lower() != "close"
+                write_response(writer, status, response, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body):
+        path = path.split("?")[0].rstrip("/")
+
+        if method == "GET":
+            match path:
+                case "/nodes":
+                    return {"nodes": list(load_nodes_config())}
+                case "/stats":
+                    return self.stats.report(self.coalescer)
+            raise HTTPError(404, f"Unknown endpoint: {path}")
+
+        if method != "POST":
+            raise HTTPError(405, f"Unsupported method: {method}")
+
+        try:
+            inputs = json.loads(body or b"{}")
+        except ValueError:
+            raise HTTPError(400, "Invalid JSON body")
+        if not isinstance(inputs, dict):
+            raise HTTPError(400, "The body must be a JSON object")
+
+        if path.startswith("/nodes/"):
+            kind, target = "node", path[len("/nodes/"):]
+            if target not in load_nodes_config():
+                raise HTTPError(404, f"Unknown node: {target}")
+        elif path == "/composer":
+            kind, target = "composer", None
+            inputs.setdefault("prompt", "")
+            inputs.setdefault("lazy", False)
+        elif path == "/cleanup":
+            kind, target = "cleanup", None
+            inputs.setdefault("prompt", "")
+            inputs.setdefault("cleanup", True)
+            inputs.setdefault("sort", "none")
+            inputs.setdefault("custom_sort", "")
+        elif path == "/pipeline":
+            kind, target = "pipeline", None
+            nodes = inputs.get("nodes")
+            if not isinstance(nodes, list):
+                raise HTTPError(400, "nodes must be a list of node ids")
+            unknown = [
+                node_id for node_id in nodes
+                if node_id not in load_nodes_config()
+            ]
+            if unknown:
+                raise HTTPError(404, f"Unknown nodes: {', '.join(unknown)}")
+        else:
+            raise HTTPError(404, f"Unknown endpoint: {path}")
+
+        seeds = inputs.pop("seeds", None)
+        seed = inputs.pop("seed", 0)
+        if seeds is not None and not isinstance(seeds, list):
+            raise HTTPError(400, "seeds must be a list of seeds")
+        for value in seeds or [seed]:
+            if not is_seed(value):
+                raise HTTPError(400, f"Invalid seed: {value!r}")
+        check_inputs(input_types(kind, target), inputs, skip=("nodes",))
+
+        # Prompts to clean up are batched together, whatever their text
+        if kind == "cleanup":
+            prompt = inputs.pop("prompt")
+            items = [(prompt, seed) for seed in seeds or [seed]]
+        else:
+            items = seeds or [seed]
+
+        prompts = await asyncio.gather(*[
+            self.coalescer.submit(kind, target, inputs, item)
+            for item in items
+        ])
+        if seeds is None:
+            return {"prompt": prompts[0]}
+        return {"prompts": prompts}
+
+
+def is_seed(value):
+    "Whether a value is a seed the nodes accept"
+    return isinstance(value, int) and not isinstance(value, bool) and \
+        0 <= value <= MAX_SEED
+
+
+def input_types(kind, target):
+    "Inputs of the node generating a kind of request"
+    match kind:
+        case "node":
+            from py.nodes.pipeline import node_class
+            return node_class(target).INPUT_TYPES()
+        case "composer":
+            from py.nodes.composer import Composer
+            return Composer.INPUT_TYPES()
+        case "cleanup":
+            from py.nodes.cleanup_prompt import CleanupPrompt
+            return CleanupPrompt.INPUT_TYPES()
+        case "pipeline":
+            from py.nodes.pipeline import Pipeline
+            return Pipeline.INPUT_TYPES()
+
+
+def check_inputs(types, inputs, skip=()):
+    """
+    Raise a 400 error for an input the node doesn't have, or a value it
+    doesn't accept. "?" suffixes are optional, as they are for nodes.
+    """
+    specs = {
+        name.rstrip("?"): spec
+        for section in ("required", "optional")
+        for name, spec in types.get(section, {}).items()
+    }
+    for name, value in inputs.items():
+        if name in skip:
+            continue
+        spec = specs.get(name.rstrip("?"))
+        if spec is None:
+            raise HTTPError(400, f"Unknown input: {name}")
+        if not is_valid(spec[0], value):
+            raise HTTPError(400, f"Invalid value of {name}: {value!r}")
+
+
+def is_valid(input_type, value):
+    "Whether a JSON value fits a ComfyUI input type"
+    number = isinstance(value, (int, float)) and not isinstance(value, bool)
+    match input_type:
+        case list():
+            return isinstance(value, str) and value in input_type
+        case "BOOLEAN":
+            # A probability can be given instead of a switch
+            return isinstance(value, bool) or number and 0 <= value <= 1
+        case "STRING":
+            return isinstance(value, str)
+        case "INT":
+            return number and isinstance(value, int)
+        case "FLOAT":
+            return number
+    return False
+
+
+async def read_request(reader):
+    "Read a HTTP request: (method, path, headers, body), None when closed"
+    line = await reader.readline()
+    if not line:
+        return None
+
+    try:
+        method, path, _ = line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise HTTPError(400, "Invalid request line")
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.decode("latin-1").partition(":")
+        headers[key.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise HTTPError(400, "Invalid Content-Length")
+    if length > MAX_BODY:
+        raise HTTPError(413, "Request body too large")
+    body = await reader.readexactly(length) if length else b""
+    return method, path, headers, body
+
+
+def write_response(writer, status, response, keep_alive=True):
+    body = json.dumps(response, ensure_ascii=False).encode("utf-8")
+    writer.write(
+        f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+        "Content-Type: application/json; charset=utf-8\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+        "\r\n".encode("latin-1") + body
+    )
+
+
+async def serve(host, port, unix, workers):
+    if workers > 0:
+        executor = ProcessPoolExecutor(workers)
+    else:
+        executor = ThreadPoolExecutor(1)
+
+    server = Server(executor)
+    if unix:
+        listener = await asyncio.start_unix_server(
+            server.handle_connection, path=unix)
+        print(f"Listening on {unix}")
+    else:
+        listener = await asyncio.start_server(
+            server.handle_connection, host, port)
+        print(f"Listening on http://{host}:{port}")
+
+    # Stop on SIGTERM like on Ctrl+C, so that the pool is shut down
+    stopped = asyncio.Event()
+    try:
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, stopped.set)
+    except NotImplementedError:
+        pass
+
+    try:
+        async with listener:
+            await stopped.wait()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Serve generated prompts over a local HTTP server."
+    )
+
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="Host to listen on"
+    )
+
+    parser.add_argument(
+        "-p", "--port",
+        type=int,
+        default=8189,
+        help="Port to listen on"
+    )
+
+    parser.add_argument(
+        "-u", "--unix",
+        help="Listen on a Unix socket instead"
+    )
+
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        default=2,
+        help="Number of worker processes (0: a single worker thread)"
+    )
+
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix, args.workers))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,56 @@
+import os
+import unittest
+
+from py.utils.config import ConfigStore, ROOT_PATH, RESERVED_KEYS
+from py.nodes.node_factory._rules import RuleSet
+
+
+def default_config(path=""):
+    return os.path.join(ROOT_PATH, "config.default", path)
+
+
+def config_tags(data):
+    "Every tag and group label of a config tree"
+    if isinstance(data, str):
+        return {data}
+    tags = set()
+    if isinstance(data, list):
+        for value in data:
+            tags |= config_tags(value)
+    elif isinstance(data, dict):
+        for key, value in data.items():
+            if key in RESERVED_KEYS:
+                continue
+            if key != "tags":
+                tags.add(key)
+            tags |= config_tags(value)
+    return tags
+
+
+class TestDefaultRules(unittest.TestCase):
+
+    def setUp(self):
+        store = ConfigStore(default_config)
+        self.nodes = store.nodes()
+        self.rules = RuleSet(store.rules(), self.nodes)
+        self.tags = config_tags(dict(self.nodes)) | \
+            config_tags(dict(store.variables()))
+
+    def test_targets_resolve(self):
+        self.assertEqual(self.rules.unresolved, [])
+
+    def test_triggers_exist(self):
+        for rule in self.rules.rules:
+            for trigger in rule["triggers"]:
+                self.assertIn(trigger, self.tags)
+
+    def test_removed_tags_exist(self):
+        for actions in self.rules.actions:
+            for action in actions:
+                target_tags = config_tags(action.target)
+                for tag in action.remove_tags:
+                    self.assertIn(tag, target_tags)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+
+import numpy as np
+
+from py.nodes.cleanup_prompt import CleanupPrompt
+from py.nodes.node_factory._compiler import compile_tags
+from py.nodes.node_factory._tag_list import TagList
+
+
+class TestTagList(unittest.TestCase):
+
+    def sample(self, data, seed):
+        "Text of a group and the tags of its tag list"
+        parts = []
+        text = compile_tags(data).sample(
+            np.random.default_rng(seed), parts=parts, path="group")
+        return text, TagList.from_pairs("node", parts)
+
+    def test_empty_tag_in_multi_pick(self):
+        "An empty tag, the 'maybe none' idiom, never makes a tag"
+        data = {"tags": ["", "ring", "necklace", "boots"], "number": 2}
+        for seed in range(50):
+            text, tags = self.sample(data, seed)
+            self.assertEqual(tags.text(), text)
+            self.assertTrue(all(tag.text for tag in tags))
+            self.assertTrue(all(tag.group == "group" for tag in tags))
+
+            # Cleaning the tag list gives the cleaned prompt
+            cleanup = CleanupPrompt()
+            args = (True, "asc", "", seed)
+            self.assertEqual(
+                cleanup.cleanup_prompt(text, *args)[0],
+                cleanup.cleanup_prompt("", *args, tags=tags)[0])
+
+    def test_tag_with_commas_is_kept(self):
+        data = {"tags": {"prefix": "a, b, c", "other": ["d", "e"]}}
+        text, tags = self.sample({**data, "number": 2}, 0)
+        self.assertIn("a, b, c", [tag.text for tag in tags])
+        self.assertEqual(tags.text(), text)
+        self.assertEqual(
+            {tag.group for tag in tags}, {"group/prefix", "group/other"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -12,7 +12,8 @@ const TypeSlotEvent = {
 
 const _ID = "MergeStrings";
 const _PREFIX = "string";
-const _TYPE = "STRING";
+// Dynamic inputs accept strings and tag lists
+const _TYPE = "STRING,TAG_LIST";
 
 app.registerExtension({
   name: 'cozy_ex.' + _ID,